@@ -8,16 +8,55 @@
     :copyright: 2010 by Daniel Neuhäuser
     :license: BSD, see LICENSE for details.
 """
+import os
 import sys
+import copy
+import json
+import time
+import shlex
+import pickle
+import threading
+import multiprocessing
 import codecs
+import socket
+import mmap
+import bisect
+import marshal
+import atexit
+from array import array
+from stat import S_ISDIR, S_ISREG
 from decimal import Decimal
-from inspect import getmembers
-from itertools import count, izip_longest, izip
+from collections import OrderedDict, namedtuple
+from inspect import getmembers, cleandoc
+from itertools import chain, count, izip, izip_longest
 from operator import attrgetter, itemgetter
+from StringIO import StringIO
+from ConfigParser import RawConfigParser
+from multiprocessing.pool import ThreadPool
+from fnmatch import fnmatch
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 __all__ = ["Option", "BooleanOption", "IntOption", "FloatOption",
-           "DecimalOption", "MultipleOptions", "Positional", "IntPositional",
-           "FloatPositional", "DecimalPositional", "Command", "Parser"]
+           "DecimalOption", "MultipleOptions", "AccumulatingOption",
+           "AppendOption", "SetOption", "CountOption", "Positional",
+           "IntPositional", "FloatPositional", "DecimalPositional",
+           "StreamPositional", "Command", "Parser", "ConfigSource",
+           "ConverterCache", "CompiledParser", "TokenStream", "tokenize",
+           "Column", "ColumnarResults", "CallPath", "IncrementalParser",
+           "Telemetry", "FileSink", "UDPSink", "ChoiceProvider",
+           "DynamicChoiceOption", "Choices", "ChoiceOption",
+           "ChoicePositional", "RangeSet", "RangeSetOption", "LazyFile",
+           "FileOption", "FilePositional", "PathPositional",
+           "GlobPositional", "DocstringDescription", "ResourceDescription",
+           "LazyCommand", "PluginRegistry", "Constraint", "Required",
+           "Exclusive", "Requires", "Conflicts", "ConstraintPlan"]
 
 missing = object()
 _next_position_hint = count().next
@@ -29,6 +68,9 @@ class Missing(object):
     def __repr__(self):
         return "missing"
 
+    def __reduce__(self):
+        return "missing"
+
 #: Represents the absence of a value.
 missing = Missing()
 del Missing
@@ -46,6 +88,44 @@ def decode_arguments(arguments,
         decoded.append(argument)
     return decoded
 
+def split_line(line):
+    """
+    Splits the given `line` into a list of arguments using POSIX shell
+    syntax.
+    """
+    if isinstance(line, unicode):
+        return [argument.decode("utf-8")
+                for argument in shlex.split(line.encode("utf-8"))]
+    return shlex.split(line)
+
+def iter_separated(fobj, chunk_size, separator=None):
+    """
+    Yields the non-empty items in the given byte stream `fobj` which is read
+    in chunks of `chunk_size` bytes.
+
+    If no `separator` is given, items are seperated by NUL bytes if the first
+    chunk contains one and by newlines otherwise.
+    """
+    rest = b""
+    while True:
+        chunk = fobj.read(chunk_size)
+        if not chunk:
+            break
+        if separator is None:
+            separator = b"\0" if b"\0" in chunk else b"\n"
+        items = chunk.split(separator)
+        items[0] = rest + items[0]
+        rest = items.pop()
+        for item in items:
+            if separator == b"\n":
+                item = item.rstrip(b"\r")
+            if item:
+                yield item
+    if separator == b"\n":
+        rest = rest.rstrip(b"\r")
+    if rest:
+        yield rest
+
 def shorter(string):
     for i in xrange(1, len(string)):
         yield string, string[:-1]
@@ -98,6 +178,368 @@ def parse_multiple(string):
     if buffer:
         yield u''.join(buffer)
 
+#: The kinds of tokens, see :class:`TokenStream`.
+LONG_OPTION = "long option"
+SHORT_OPTIONS = "short options"
+ATTACHED_VALUE = "attached value"
+TERMINATOR = "terminator"
+WORD = "word"
+
+#: A classified argument, `value` is the argument without the prefix and
+#: the attached value in case of a long option.
+Token = namedtuple("Token", ["kind", "value", "argument"])
+
+class TokenStream(object):
+    """
+    Classifies the given `arguments` lazily and in a single pass, yielding a
+    :class:`Token` for each.
+
+    ``--long`` and ``--long=value`` become :data:`LONG_OPTION` tokens, the
+    latter followed by an :data:`ATTACHED_VALUE` token, ``-abc`` becomes a
+    :data:`SHORT_OPTIONS` token, ``--`` a :data:`TERMINATOR` and anything else
+    a :data:`WORD`.
+
+    Arguments of options are taken with :meth:`next_argument` without being
+    classified, everything after a terminator is passed on unclassified by
+    :meth:`rest`.
+    """
+    def __init__(self, arguments):
+        self.arguments = iter(arguments)
+        self.attached = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.attached is not None:
+            token, self.attached = self.attached, None
+            return token
+        argument = self.arguments.next()
+        if argument.startswith(u"--"):
+            if argument == u"--":
+                return Token(TERMINATOR, argument, argument)
+            name, seperator, value = argument[2:].partition(u"=")
+            if seperator:
+                self.attached = Token(ATTACHED_VALUE, value, argument)
+            return Token(LONG_OPTION, name, argument)
+        elif argument.startswith(u"-") and argument != u"-":
+            return Token(SHORT_OPTIONS, argument[1:], argument)
+        return Token(WORD, argument, argument)
+
+    def pop_attached_value(self):
+        """
+        Returns the value attached to the previous long option or `missing`.
+        """
+        if self.attached is None:
+            return missing
+        token, self.attached = self.attached, None
+        return token.value
+
+    def next_argument(self):
+        """
+        Returns the next argument without classifying it, raises
+        :exc:`StopIteration` if there is none.
+        """
+        if self.attached is not None:
+            return self.pop_attached_value()
+        return self.arguments.next()
+
+    def rest(self):
+        """
+        Returns an iterator over the remaining arguments which are not
+        classified.
+        """
+        return self.arguments
+
+def tokenize(arguments):
+    """
+    Returns a :class:`TokenStream` for the given `arguments`, which are
+    returned as they are if they are a token stream already.
+    """
+    if isinstance(arguments, TokenStream):
+        return arguments
+    return TokenStream(arguments)
+
+class ConverterCache(object):
+    """
+    A least recently used cache for the results of :meth:`Node.evaluate`
+    keyed on the node and the given argument.
+
+    Assign an instance to the :attr:`Node.converter_cache` attribute of a
+    node class or a single node to avoid evaluating the same argument again,
+    the cached values are shared by every evaluation so :meth:`Node.evaluate`
+    should not depend on anything else.
+
+    :param maxsize:
+        The maximum number of cached values.
+
+    :param ttl:
+        The number of seconds after which a cached value expires, by default
+        values do not expire.
+    """
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        #: The number of evaluations answered by the cache.
+        self.hits = 0
+        #: The number of evaluations which had to call :meth:`Node.evaluate`.
+        self.misses = 0
+        self._values = OrderedDict()
+        self._lock = threading.Lock()
+
+    def evaluate(self, node, callpath, argument):
+        """
+        Returns the cached value for the given `node` and `argument` or
+        evaluates it.
+        """
+        key = node, argument
+        with self._lock:
+            try:
+                value, expires = self._values.pop(key)
+            except KeyError:
+                pass
+            else:
+                if expires is None or expires > time.time():
+                    self._values[key] = value, expires
+                    self.hits += 1
+                    return value
+            self.misses += 1
+        value = node.evaluate(callpath, argument)
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._values[key] = value, expires
+            if len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+        return value
+
+    def clear(self):
+        """
+        Removes every cached value and resets the statistics.
+        """
+        with self._lock:
+            self._values.clear()
+            self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "{0}(maxsize={1!r}, ttl={2!r})".format(
+            self.__class__.__name__, self.maxsize, self.ttl
+        )
+
+#: Kinds of events counted by :class:`Telemetry`.
+COMMAND, OPTION, ERROR = u"commands", u"options", u"errors"
+
+class Telemetry(object):
+    """
+    Counts the dispatched commands, the given options and the errors of
+    evaluations and passes the counts to the given `sink` in batches.
+
+    Install it on a parser with :meth:`install`, which sets the
+    :attr:`Command.telemetry` attribute of every command. Commands only note
+    the raw option arguments during an evaluation, they are resolved to the
+    names of the options when the counts are flushed by a background thread,
+    every `flush_interval` seconds or once `batch_size` different events
+    have been counted, and when the process exits.
+
+    :param sink:
+        A callable which is called with a dictionary mapping
+        :data:`COMMAND`, :data:`OPTION` and :data:`ERROR` to dictionaries
+        mapping the paths of the commands and options like ``"build.jobs"``
+        or the errors to counts, like :class:`FileSink` and
+        :class:`UDPSink`.
+
+    :param sample_every:
+        Only every nth evaluation of a command is counted, errors are always
+        counted.
+    """
+    def __init__(self, sink, sample_every=1, flush_interval=60.0,
+                 batch_size=1024):
+        self.sink = sink
+        self.sample_every = sample_every
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._countdown = sample_every
+        self._counts = {}
+        self._paths = {}
+        self._flush_requested = threading.Event()
+        self._counts_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def install(self, parser, path=u""):
+        """
+        Installs this telemetry on every command of the given `parser`,
+        whose commands are counted under the given `path`.
+
+        The help command shared by every command is left alone, so other
+        parsers are not affected. A :class:`LazyCommand` which has not been
+        imported yet installs the telemetry on the imported command itself.
+        """
+        stack = [(path, parser)]
+        while stack:
+            path, command = stack.pop()
+            if id(command) in self._paths or command is help_command:
+                continue
+            self._paths[id(command)] = path
+            command.telemetry = self
+            if isinstance(command, LazyCommand):
+                if is_loaded(command):
+                    stack.append((path, command.command))
+                continue
+            for name, subcommand in command.commands.iteritems():
+                stack.append((path + u"." + name if path else name,
+                              subcommand))
+
+    def sample(self):
+        """
+        Returns ``True`` if the current evaluation should be counted.
+        """
+        with self._counts_lock:
+            self._countdown -= 1
+            if self._countdown > 0:
+                return False
+            self._countdown = self.sample_every
+            return True
+
+    def count(self, command, kind, value):
+        """
+        Counts an event of the given `kind` with the given `value` for the
+        given `command`.
+
+        The value is the name of the dispatched command, the name of the
+        option with a leading ``-`` or ``--`` or the name of the error.
+        """
+        key = command, kind, value
+        with self._counts_lock:
+            counts = self._counts
+            counts[key] = counts.get(key, 0) + 1
+        if self._thread is None:
+            self.start()
+        elif len(counts) >= self.batch_size:
+            self._flush_requested.set()
+
+    def start(self):
+        """
+        Starts the thread flushing the counts and makes sure the counts are
+        flushed when the process exits.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Passes the counts to the sink and starts counting from zero.
+        """
+        with self._lock:
+            with self._counts_lock:
+                counts, self._counts = self._counts, {}
+            if not counts:
+                return
+            batch = {COMMAND: {}, OPTION: {}, ERROR: {}}
+            for (command, kind, value), n in counts.iteritems():
+                path = self.get_path(command)
+                if kind == OPTION:
+                    names = [self.get_option_name(command, value)]
+                    if not value.startswith(u"--"):
+                        names = [self.get_option_name(command, u"-" + short)
+                                 for short in value[1:]]
+                    for name in names:
+                        key = path + u"." + name if path else name
+                        batch[kind][key] = batch[kind].get(key, 0) + n
+                else:
+                    if kind == COMMAND:
+                        value = path + u"." + value if path else value
+                    batch[kind][value] = batch[kind].get(value, 0) + n
+            self.sink(batch)
+
+    def get_path(self, command):
+        """
+        Returns the path under which the given `command` is counted.
+        """
+        return self._paths.get(id(command), u"")
+
+    def get_option_name(self, command, argument):
+        """
+        Returns the name of the option of the given `command` the given
+        `argument` refers to or the argument itself.
+        """
+        try:
+            if argument.startswith(u"--"):
+                return command.long_options[argument[2:].partition(u"=")[0]][0]
+            return command.short_options[argument[1:]][0]
+        except KeyError:
+            return argument
+
+    def __repr__(self):
+        return "{0}({1!r}, sample_every={2!r})".format(
+            self.__class__.__name__, self.sink, self.sample_every
+        )
+
+class FileSink(object):
+    """
+    Appends every batch of :class:`Telemetry` counts with a timestamp as a
+    line of JSON to the file at the given `path`.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, batch):
+        batch = dict(batch, time=time.time())
+        with open(self.path, "ab") as file:
+            file.write(json.dumps(batch) + "\n")
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.path)
+
+class UDPSink(object):
+    """
+    Sends every batch of :class:`Telemetry` counts with a timestamp as a
+    JSON datagram to the given ``(host, port)`` `address`.
+    """
+    def __init__(self, address):
+        self.address = address
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, batch):
+        batch = dict(batch, time=time.time())
+        try:
+            self._socket.sendto(json.dumps(batch), self.address)
+        except socket.error:
+            pass
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.address)
+
+def evaluate_node(node, callpath, argument):
+    """
+    Evaluates the given `argument` with the given `node` using the converter
+    cache of the node, if it has one.
+    """
+    if node.converter_cache is None:
+        return node.evaluate(callpath, argument)
+    return node.converter_cache.evaluate(node, callpath, argument)
+
 class Node(object):
     """
     Represents an argument passed to your script.
@@ -107,15 +549,31 @@ class Node(object):
 
     :param long_description:
         A longer detailed description.
+
+    Descriptions may also be given as callables returning them, like
+    :class:`DocstringDescription` and :class:`ResourceDescription`, which
+    are called once when the description is needed first.
     """
+    #: A :class:`ConverterCache` used to cache the results of
+    #: :meth:`evaluate`.
+    converter_cache = None
+
     def __init__(self, short_description=None, long_description=None):
         self.short_description = short_description
         self.long_description = long_description
         self._position_hint = _next_position_hint()
 
+    def _resolve_description(self, name):
+        description = getattr(self, name)
+        if callable(description):
+            description = description()
+            setattr(self, name, description)
+        return description
+
     @property
     def short_description(self):
-        return self._short_description or u"No short description."
+        description = self._resolve_description("_short_description")
+        return description or u"No short description."
 
     @short_description.setter
     def short_description(self, short_description):
@@ -123,7 +581,8 @@ class Node(object):
 
     @property
     def long_description(self):
-        desc = self._long_description or self._short_description
+        desc = self._resolve_description("_long_description") or \
+                self._resolve_description("_short_description")
         return desc or u"No long description."
 
     @long_description.setter
@@ -142,6 +601,69 @@ class Node(object):
                 .format(self.__class__.__name__, self.short_description,
                         self.long_description)
 
+def import_object(name):
+    """
+    Imports and returns the object with the given name like
+    ``"package.module:Class.attribute"``.
+    """
+    module, _, attributes = name.partition(":")
+    obj = __import__(module, fromlist=["__name__"])
+    for attribute in filter(None, attributes.split(".")):
+        obj = getattr(obj, attribute)
+    return obj
+
+class DocstringDescription(object):
+    """
+    A description taken from the docstring of the given object or of the
+    object with the given name like ``"package.module:Class.method"``, which
+    is only imported when the description is needed. If `summary` is
+    ``True`` only the first paragraph is used.
+    """
+    def __init__(self, obj, summary=False):
+        self.obj = obj
+        self.summary = summary
+
+    def __call__(self):
+        obj = self.obj
+        if isinstance(obj, basestring):
+            obj = import_object(obj)
+        description = cleandoc(obj.__doc__ or "")
+        if isinstance(description, str):
+            description = description.decode("utf-8")
+        if self.summary:
+            description = description.split(u"\n\n")[0].replace(u"\n", u" ")
+        return description or None
+
+    def __repr__(self):
+        return "{0}({1!r}, summary={2!r})".format(
+            self.__class__.__name__, self.obj, self.summary
+        )
+
+class ResourceDescription(object):
+    """
+    A description stored under the given `key` in the JSON object in the
+    file at the given `path`, which is read when a description from it is
+    needed first.
+    """
+    #: Maps the paths of the files read to their contents.
+    resources = {}
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+
+    def __call__(self):
+        try:
+            descriptions = self.resources[self.path]
+        except KeyError:
+            with open(self.path, "rb") as f:
+                descriptions = self.resources[self.path] = json.load(f)
+        return descriptions.get(self.key)
+
+    def __repr__(self):
+        return "{0}({1!r}, {2!r})".format(self.__class__.__name__,
+                                          self.path, self.key)
+
 class IntNodeMixin(object):
     def evaluate(self, callpath, argument):
         return int(argument)
@@ -154,6 +676,266 @@ class DecimalNodeMixin(object):
     def evaluate(self, callpath, argument):
         return Decimal(argument)
 
+def common_prefix_length(a, b):
+    """
+    Returns the length of the longest common prefix of `a` and `b`.
+    """
+    length = 0
+    for x, y in izip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+class Choices(object):
+    """
+    An index of the given `choices`, which may be an iterable of strings, a
+    dictionary mapping strings to values or an enumeration with a
+    ``__members__`` mapping.
+
+    Choices are looked up in a dictionary, unique prefixes of them in an
+    index which is created once when it is needed first.
+    """
+    def __init__(self, choices):
+        members = getattr(choices, "__members__", None)
+        if members is not None:
+            choices = members
+        if isinstance(choices, dict):
+            self.values = dict(choices)
+        else:
+            self.values = dict((choice, choice) for choice in choices)
+        #: A frozen set of the choices.
+        self.names = frozenset(self.values)
+        #: A sorted tuple of the choices.
+        self.sorted = tuple(sorted(self.values))
+        self._prefixes = None
+
+    @property
+    def prefixes(self):
+        """
+        A dictionary mapping every unique prefix of a choice to the choice.
+        """
+        if self._prefixes is None:
+            prefixes = {}
+            names = self.sorted
+            for i, name in enumerate(names):
+                length = 0
+                if i > 0:
+                    length = common_prefix_length(names[i - 1], name)
+                if i + 1 < len(names):
+                    length = max(length,
+                                 common_prefix_length(name, names[i + 1]))
+                for end in xrange(length + 1, len(name)):
+                    prefixes[name[:end]] = name
+            self._prefixes = prefixes
+        return self._prefixes
+
+    def lookup(self, argument, allow_abbreviations=True):
+        """
+        Returns the value of the choice given by the `argument` or a unique
+        prefix of it, raises :exc:`KeyError` if there is no such choice.
+        """
+        try:
+            return self.values[argument]
+        except KeyError:
+            if not allow_abbreviations:
+                raise
+        return self.values[self.prefixes[argument]]
+
+    def complete(self, prefix):
+        """
+        Returns a sorted list of the choices starting with the given
+        `prefix`.
+        """
+        names = self.sorted
+        start = end = bisect.bisect_left(names, prefix)
+        while end < len(names) and names[end].startswith(prefix):
+            end += 1
+        return list(names[start:end])
+
+    def get_suggestions(self, argument, limit=5):
+        """
+        Returns up to `limit` choices sharing the longest possible prefix with
+        the given `argument`.
+        """
+        for end in xrange(len(argument), 0, -1):
+            suggestions = self.complete(argument[:end])
+            if suggestions:
+                return suggestions[:limit]
+        return []
+
+    def get_error_message(self, argument):
+        """
+        Returns a message stating that `argument` is not a valid choice,
+        with suggestions if there are any.
+        """
+        suggestions = self.get_suggestions(argument)
+        if suggestions:
+            return u"invalid choice: {0}, did you mean {1}?".format(
+                argument, u", ".join(suggestions)
+            )
+        return u"invalid choice: {0}".format(argument)
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def __iter__(self):
+        return iter(self.sorted)
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.values)
+
+class LazyFile(object):
+    """
+    A file at the given `path` which is opened with the given `mode` and
+    `buffering` when it is used first. ``-`` refers to :data:`sys.stdin` or
+    :data:`sys.stdout` depending on the mode, which are never closed.
+
+    Attributes of the file object can be accessed on the lazy file itself.
+    """
+    def __init__(self, path, mode="rb", buffering=-1):
+        self.path = path
+        self.mode = mode
+        self.buffering = buffering
+        self._file = None
+        self._mmap = None
+
+    @property
+    def is_standard_stream(self):
+        """
+        ``True`` if the path is ``-``.
+        """
+        return self.path == u"-"
+
+    @property
+    def opened(self):
+        """
+        ``True`` if the file has been opened.
+        """
+        return self._file is not None
+
+    @property
+    def file(self):
+        """
+        The file object, the file is opened on first access.
+        """
+        if self._file is None:
+            if self.is_standard_stream:
+                self._file = sys.stdin if "r" in self.mode else sys.stdout
+            else:
+                self._file = open(self.path, self.mode, self.buffering)
+        return self._file
+
+    def mmap(self):
+        """
+        Returns a read-only :class:`mmap.mmap` of the file, which provides
+        the contents without reading them into memory. Files of size zero
+        cannot be mapped.
+        """
+        if self._mmap is None:
+            self._mmap = mmap.mmap(self.file.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        return self._mmap
+
+    def close(self):
+        """
+        Closes the map and the file, if they have been opened.
+        """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            if not self.is_standard_stream:
+                self._file.close()
+            self._file = None
+
+    def __iter__(self):
+        return iter(self.file)
+
+    def __getattr__(self, name):
+        if name.startswith(u"_"):
+            raise AttributeError(name)
+        return getattr(self.file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "{0}({1!r}, mode={2!r}, buffering={3!r})".format(
+            self.__class__.__name__, self.path, self.mode, self.buffering
+        )
+
+def close_files(result):
+    """
+    Closes the :class:`LazyFile` objects in the given result of evaluating
+    a command, including those in lists, tuples and sets.
+    """
+    options, arguments = result
+    values = list(arguments) if isinstance(arguments, list) else []
+    if isinstance(options, dict):
+        values.extend(options.itervalues())
+    for value in values:
+        if isinstance(value, LazyFile):
+            value.close()
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            for item in value:
+                if isinstance(item, LazyFile):
+                    item.close()
+
+class FileNodeMixin(object):
+    #: The mode the file is opened with.
+    mode = "rb"
+
+    #: The buffer size the file is opened with, see :func:`open`.
+    buffering = -1
+
+    def evaluate(self, callpath, argument):
+        if argument != u"-":
+            self.validate(argument)
+        return LazyFile(argument, self.mode, self.buffering)
+
+    def validate(self, path):
+        """
+        Raises :exc:`ValueError` unless the file at the given `path` can be
+        opened with the mode, without opening it.
+        """
+        if "r" in self.mode:
+            if not os.path.isfile(path):
+                raise ValueError(u"not a file: {0}".format(path))
+            if not os.access(path, os.R_OK):
+                raise ValueError(u"file not readable: {0}".format(path))
+        if "r" not in self.mode or "+" in self.mode:
+            if os.path.exists(path):
+                writable = os.path.isfile(path) and os.access(path, os.W_OK)
+            else:
+                writable = os.access(os.path.dirname(path) or u".", os.W_OK)
+            if not writable:
+                raise ValueError(u"file not writable: {0}".format(path))
+
+class ChoiceNodeMixin(object):
+    #: If ``True`` a unique prefix of a choice may be given instead.
+    allow_abbreviated_choices = True
+
+    def evaluate(self, callpath, argument):
+        choices = self.choices
+        try:
+            return choices.lookup(argument, self.allow_abbreviated_choices)
+        except KeyError:
+            raise ValueError(choices.get_error_message(argument))
+
+    def complete(self, prefix):
+        """
+        Returns a sorted list of the choices starting with the given
+        `prefix`.
+        """
+        return self.choices.complete(prefix)
+
 class Option(Node):
     """
     Represents a string option.
@@ -181,6 +963,10 @@ class Option(Node):
     #: require it.
     allows_optional_argument = False
 
+    #: Set to ``True`` if the values of repeated occurrences of this option
+    #: are accumulated, see :class:`AccumulatingOption`.
+    accumulates = False
+
     def __init__(self, short=None, long=None, default=missing,
                  short_description=None, long_description=None):
         Node.__init__(self, short_description=short_description,
@@ -220,7 +1006,7 @@ class BooleanOption(Option):
                         long_description=long_description)
 
     def evaluate(self, callpath):
-        return not self.default
+        return not get_default(callpath, self)
 
 class IntOption(IntNodeMixin, Option):
     """
@@ -237,62 +1023,427 @@ class DecimalOption(DecimalNodeMixin, Option):
     Represents a decimal option.
     """
 
-class MultipleOptions(Option):
+class FileOption(FileNodeMixin, Option):
     """
-    Represents multiple values which are evaluated using the given
-    ``sub_option``.
-
-    The values are seperated by commas, strings containing commas can be
-    represented using single and double quotes::
+    Represents an option which evaluates to a :class:`LazyFile`, after
+    checking that the file can be opened with the given `mode`.
 
-        "foo,bar,baz"   -> ["foo", "bar", "baz"]
-        "foo,'bar,bar'" -> ["foo", "bar,baz"]
-        'foo,"bar,baz"' -> ["foo", "bar,baz"]
+    The file is opened when it is used first and closed once the callback
+    the result is passed to returns.
     """
-    def __init__(self, sub_option=Option, short=None, long=None,
-                 default=missing, short_description=None,
-                 long_description=None):
+    def __init__(self, short=None, long=None, default=missing, mode="rb",
+                 buffering=-1, short_description=None, long_description=None):
         Option.__init__(self, short=short, long=long, default=default,
                         short_description=short_description,
                         long_description=long_description)
-        self.sub_option = sub_option(long=u'sub-option')
-
-    def evaluate(self, callpath, argument):
-        sub_option_cp = callpath + [(u'--sub-option', self.sub_option)]
-        return [
-            self.sub_option.evaluate(sub_option_cp, arg)
-            for arg in parse_multiple(argument)
-        ]
+        self.mode = mode
+        self.buffering = buffering
 
-class Positional(Node):
+class ChoiceOption(ChoiceNodeMixin, Option):
     """
-    Represents a positional string argument.
-
-    :param metavar:
-        The metavariable which should be used to represent this argument in the
-        help message and the usage string.
+    Represents an option whose value has to be one of the given `choices`,
+    see :class:`Choices`. The option evaluates to the value the choice is
+    mapped to.
     """
-    def __init__(self, metavar, short_description=None, long_description=None):
-        Node.__init__(self, short_description=short_description,
-                      long_description=long_description)
-        self.metavar = metavar
-
-    def evaluate(self, callpath, argument):
-        return argument
-
-    def __repr__(self):
-        return '{0}({1!r}, short_description={2!r}, long_description={3!r})'. \
-                format(self.__class__.__name__, self.metavar,
-                       self.short_description, self.long_description)
+    def __init__(self, choices, short=None, long=None, default=missing,
+                 short_description=None, long_description=None):
+        Option.__init__(self, short=short, long=long, default=default,
+                        short_description=short_description,
+                        long_description=long_description)
+        if not isinstance(choices, Choices):
+            choices = Choices(choices)
+        self.choices = choices
 
-class IntPositional(IntNodeMixin, Positional):
-    """
-    Represents a positional integer argument.
+class ChoiceProvider(object):
     """
+    Caches the choices returned by calling the given `provider` in memory
+    and, if a `cache_file` is given and the values of the choices can be
+    marshaled, on disk.
 
-class FloatPositional(FloatNodeMixin, Positional):
-    """
-    Represents a positional float argument.
+    Choices older than `ttl` seconds are still used but refreshed by calling
+    the provider in a background thread, so the provider is only called
+    while evaluating if there are no cached choices at all.
+    """
+    def __init__(self, provider, ttl=300, cache_file=None):
+        self.provider = provider
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self._entry = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get_entry(self):
+        """
+        Returns a tuple of the time the choices were provided and the
+        :class:`Choices`.
+        """
+        entry = self._entry
+        if entry is None:
+            with self._lock:
+                if self._entry is None:
+                    self._entry = self.read_cache_file() or self.refresh()
+                entry = self._entry
+        if self.ttl is not None and entry[0] + self.ttl <= time.time():
+            self.start_refresh()
+        return entry
+
+    def get_choices(self):
+        """
+        Returns the :class:`Choices`.
+        """
+        return self.get_entry()[1]
+
+    def refresh(self):
+        """
+        Calls the provider and caches the choices.
+        """
+        entry = self._entry = time.time(), Choices(self.provider())
+        if self.cache_file is not None:
+            self.write_cache_file(entry)
+        return entry
+
+    def start_refresh(self):
+        """
+        Refreshes the choices in a background thread unless that is already
+        happening.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self._refresh_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            # keep using the stale choices
+            pass
+        finally:
+            self._refreshing = False
+
+    def read_cache_file(self):
+        if self.cache_file is None:
+            return None
+        try:
+            with open(self.cache_file, "rb") as f:
+                timestamp, choices = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        return timestamp, Choices(choices)
+
+    def write_cache_file(self, entry):
+        try:
+            content = marshal.dumps((entry[0], entry[1].values))
+        except ValueError:
+            # the values cannot be stored, like enumeration members
+            return
+        tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(content)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            # the provider is called again next time
+            pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_refreshing"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "{0}({1!r}, ttl={2!r}, cache_file={3!r})".format(
+            self.__class__.__name__, self.provider, self.ttl, self.cache_file
+        )
+
+class DynamicChoiceOption(ChoiceNodeMixin, Option):
+    """
+    Represents an option whose value has to be one of the choices returned
+    by the given `provider`, which is either a :class:`ChoiceProvider` or a
+    callable a provider with the default settings is created for.
+    """
+    allow_abbreviated_choices = False
+
+    def __init__(self, provider, short=None, long=None, default=missing,
+                 short_description=None, long_description=None):
+        Option.__init__(self, short=short, long=long, default=default,
+                        short_description=short_description,
+                        long_description=long_description)
+        if not isinstance(provider, ChoiceProvider):
+            provider = ChoiceProvider(provider)
+        self.provider = provider
+
+    @property
+    def choices(self):
+        return self.provider.get_choices()
+
+class MultipleOptions(Option):
+    """
+    Represents multiple values which are evaluated using the given
+    ``sub_option``.
+
+    The values are seperated by commas, strings containing commas can be
+    represented using single and double quotes::
+
+        "foo,bar,baz"   -> ["foo", "bar", "baz"]
+        "foo,'bar,bar'" -> ["foo", "bar,baz"]
+        'foo,"bar,baz"' -> ["foo", "bar,baz"]
+    """
+    def __init__(self, sub_option=Option, short=None, long=None,
+                 default=missing, short_description=None,
+                 long_description=None):
+        Option.__init__(self, short=short, long=long, default=default,
+                        short_description=short_description,
+                        long_description=long_description)
+        self.sub_option = sub_option(long=u'sub-option')
+
+    def evaluate(self, callpath, argument):
+        sub_option_cp = callpath.extend(u"--sub-option", self.sub_option)
+        return [
+            evaluate_node(self.sub_option, sub_option_cp, arg)
+            for arg in parse_multiple(argument)
+        ]
+
+class AccumulatingOption(Option):
+    """
+    Base class for options which may be given several times, the values of
+    every occurrence are accumulated in a single container which is created
+    once per evaluation of the command the option belongs to.
+    """
+    accumulates = True
+
+    def create_container(self, default):
+        """
+        Returns a new container, with the contents of the given `default`
+        unless it is `missing`.
+        """
+        raise NotImplementedError("{0}.create_container(default)"
+                                  .format(self.__class__.__name__))
+
+    def accumulate(self, container, value):
+        """
+        Adds the given `value` to the `container` and returns the container.
+        """
+        raise NotImplementedError("{0}.accumulate(container, value)"
+                                  .format(self.__class__.__name__))
+
+class AppendOption(AccumulatingOption):
+    """
+    Represents an option which evaluates to a list of the values of every
+    occurrence, each evaluated using the given ``sub_option``::
+
+        -I foo -I bar --include baz -> ["foo", "bar", "baz"]
+    """
+    def __init__(self, sub_option=Option, short=None, long=None,
+                 default=missing, short_description=None,
+                 long_description=None):
+        AccumulatingOption.__init__(self, short=short, long=long,
+                                    default=default,
+                                    short_description=short_description,
+                                    long_description=long_description)
+        self.sub_option = sub_option(long=u"sub-option")
+
+    def evaluate(self, callpath, argument):
+        sub_option_cp = callpath.extend(u"--sub-option", self.sub_option)
+        return evaluate_node(self.sub_option, sub_option_cp, argument)
+
+    def create_container(self, default):
+        return [] if default is missing else list(default)
+
+    def accumulate(self, container, value):
+        container.append(value)
+        return container
+
+class SetOption(AppendOption):
+    """
+    Represents an option which evaluates to a set of the values of every
+    occurrence, each evaluated using the given ``sub_option``.
+    """
+    def create_container(self, default):
+        return set() if default is missing else set(default)
+
+    def accumulate(self, container, value):
+        container.add(value)
+        return container
+
+class CountOption(AccumulatingOption):
+    """
+    Represents an option which evaluates to the number of its occurrences::
+
+        -vvv --verbose -> 4
+    """
+    requires_argument = False
+
+    def evaluate(self, callpath):
+        return 1
+
+    def create_container(self, default):
+        return 0 if default is missing else default
+
+    def accumulate(self, container, value):
+        return container + value
+
+class RangeSet(object):
+    """
+    An immutable set of integers stored as sorted, non-overlapping ranges,
+    which are never expanded.
+
+    `ranges` is an iterable of ``(start, stop)`` tuples with `stop` being
+    excluded, overlapping and adjacent ranges are merged.
+    """
+    def __init__(self, ranges=()):
+        merged = []
+        for start, stop in sorted(ranges):
+            if start >= stop:
+                continue
+            if merged and start <= merged[-1][1]:
+                if stop > merged[-1][1]:
+                    merged[-1] = merged[-1][0], stop
+            else:
+                merged.append((start, stop))
+        #: A tuple of the merged ``(start, stop)`` tuples.
+        self.ranges = tuple(merged)
+        self._starts = [start for start, _ in merged]
+
+    @classmethod
+    def parse(cls, specification):
+        """
+        Returns a range set for a comma separated `specification` of
+        integers, inclusive ranges like ``0-9`` and slices like ``0:10``.
+
+        Raises :exc:`ValueError` if an item is not an integer or a range
+        starts after its end.
+        """
+        ranges = []
+        for item in specification.split(u","):
+            item = item.strip()
+            if not item:
+                continue
+            start, separator, end = item.partition(u":")
+            if separator:
+                # slices exclude their end, ``3:3`` is empty
+                start, stop = int(start), int(end)
+                backwards = start > stop
+            else:
+                start, separator, end = item.partition(u"-")
+                start = int(start)
+                end = int(end) if separator else start
+                stop = end + 1
+                backwards = start > end
+            if backwards:
+                raise ValueError("range starts after its end: {0!r}"
+                                 .format(item))
+            ranges.append((start, stop))
+        return cls(ranges)
+
+    def __contains__(self, number):
+        i = bisect.bisect_right(self._starts, number) - 1
+        return i >= 0 and number < self.ranges[i][1]
+
+    def __iter__(self):
+        for start, stop in self.ranges:
+            number = start
+            while number < stop:
+                yield number
+                number += 1
+
+    def __len__(self):
+        return sum(stop - start for start, stop in self.ranges)
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def __or__(self, other):
+        return RangeSet(self.ranges + other.ranges)
+
+    union = __or__
+
+    def __eq__(self, other):
+        if isinstance(other, RangeSet):
+            return self.ranges == other.ranges
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.ranges)
+
+    def __unicode__(self):
+        return u",".join(
+            unicode(start) if stop == start + 1 else
+            u"{0}-{1}".format(start, stop - 1)
+            for start, stop in self.ranges
+        )
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, list(self.ranges))
+
+class RangeSetOption(AccumulatingOption):
+    """
+    Represents an option which evaluates to a :class:`RangeSet` of the
+    integers given by every occurrence::
+
+        --shards 0-9999,20000-29999 --shards 5,10:20 -> 0-9999,20000-29999
+    """
+    def evaluate(self, callpath, argument):
+        return RangeSet.parse(argument)
+
+    def create_container(self, default):
+        if default is missing:
+            return RangeSet()
+        elif isinstance(default, basestring):
+            return RangeSet.parse(default)
+        return default
+
+    def accumulate(self, container, value):
+        return container | value
+
+class Positional(Node):
+    """
+    Represents a positional string argument.
+
+    :param metavar:
+        The metavariable which should be used to represent this argument in the
+        help message and the usage string.
+    """
+    #: An argument which is evaluated if none is given for this positional.
+    implicit_argument = missing
+
+    #: If ``True`` the positional is evaluated once with a list of all
+    #: remaining arguments, it has to be the last positional.
+    takes_remaining = False
+
+    def __init__(self, metavar, short_description=None, long_description=None):
+        Node.__init__(self, short_description=short_description,
+                      long_description=long_description)
+        self.metavar = metavar
+
+    def evaluate(self, callpath, argument):
+        return argument
+
+    def __repr__(self):
+        return '{0}({1!r}, short_description={2!r}, long_description={3!r})'. \
+                format(self.__class__.__name__, self.metavar,
+                       self.short_description, self.long_description)
+
+class IntPositional(IntNodeMixin, Positional):
+    """
+    Represents a positional integer argument.
+    """
+
+class FloatPositional(FloatNodeMixin, Positional):
+    """
+    Represents a positional float argument.
     """
 
 class DecimalPositional(DecimalNodeMixin, Positional):
@@ -300,401 +1451,2770 @@ class DecimalPositional(DecimalNodeMixin, Positional):
     Represents a positional float argument.
     """
 
-def get_option_attributes(obj):
-    return getmembers(obj, lambda x: isinstance(x, Option))
+class FilePositional(FileNodeMixin, Positional):
+    """
+    Represents a positional argument which evaluates to a :class:`LazyFile`,
+    see :class:`FileOption`.
+    """
+    def __init__(self, metavar, mode="rb", buffering=-1,
+                 short_description=None, long_description=None):
+        Positional.__init__(self, metavar,
+                            short_description=short_description,
+                            long_description=long_description)
+        self.mode = mode
+        self.buffering = buffering
+
+class ChoicePositional(ChoiceNodeMixin, Positional):
+    """
+    Represents a positional argument which has to be one of the given
+    `choices`, see :class:`ChoiceOption`.
+    """
+    def __init__(self, metavar, choices, short_description=None,
+                 long_description=None):
+        Positional.__init__(self, metavar,
+                            short_description=short_description,
+                            long_description=long_description)
+        if not isinstance(choices, Choices):
+            choices = Choices(choices)
+        self.choices = choices
+
+class PathPositional(Positional):
+    """
+    Represents a positional argument for a path which has to exist, be of
+    the given `kind`, ``"file"`` or ``"directory"``, if one is given and be
+    accessible with the given `access` mode like :data:`os.R_OK`.
+
+    If `variadic` is ``True`` the positional takes all remaining arguments
+    and evaluates to a list of them. Large lists are checked concurrently
+    by up to `max_workers` threads and every invalid path is reported in a
+    single error.
+    """
+    #: The minimum number of paths which are checked concurrently.
+    pool_threshold = 32
+
+    def __init__(self, metavar, kind=None, access=None, variadic=False,
+                 max_workers=16, short_description=None,
+                 long_description=None):
+        Positional.__init__(self, metavar,
+                            short_description=short_description,
+                            long_description=long_description)
+        if kind not in [None, "file", "directory"]:
+            raise ValueError("kind must be None, 'file' or 'directory'")
+        self.kind = kind
+        self.access = access
+        self.takes_remaining = variadic
+        self.max_workers = max_workers
+
+    def check(self, path):
+        """
+        Returns a message describing why the given `path` is invalid or
+        ``None`` if it is valid.
+        """
+        try:
+            mode = os.stat(path).st_mode
+        except OSError as error:
+            return u"{0}: {1}".format(path, error.strerror)
+        if self.kind == "file" and not S_ISREG(mode):
+            return u"{0}: not a file".format(path)
+        elif self.kind == "directory" and not S_ISDIR(mode):
+            return u"{0}: not a directory".format(path)
+        if self.access is not None and not os.access(path, self.access):
+            return u"{0}: permission denied".format(path)
+        return None
+
+    def evaluate(self, callpath, argument):
+        if not self.takes_remaining:
+            error = self.check(argument)
+            if error is not None:
+                raise ValueError(error)
+            return argument
+        paths = list(argument)
+        if len(paths) < self.pool_threshold:
+            errors = map(self.check, paths)
+        else:
+            pool = ThreadPool(min(self.max_workers, len(paths)))
+            try:
+                errors = pool.map(self.check, paths, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise ValueError(u"{0} invalid path{1}:\n{2}".format(
+                len(errors), u"" if len(errors) == 1 else u"s",
+                u"\n".join(errors)
+            ))
+        return paths
+
+def iter_directory(path):
+    """
+    Yields a tuple of the name of every entry in the directory at the given
+    `path` and ``True`` if it is a directory which is not a symbolic link.
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            entry = os.path.join(path, name)
+            yield name, os.path.isdir(entry) and not os.path.islink(entry)
+
+def has_magic(pattern):
+    return any(char in pattern for char in u"*?[")
+
+def iglob(pattern, recursive=True, directories_only=False):
+    """
+    Yields the paths matching the given `pattern` like :func:`glob.iglob`,
+    reading one directory at a time. If `recursive` is ``True``, ``**``
+    matches any number of directories.
+    """
+    if not has_magic(pattern):
+        if os.path.lexists(pattern) and \
+                (not directories_only or os.path.isdir(pattern)):
+            yield pattern
+        return
+    dirname, basename = os.path.split(pattern)
+    if has_magic(dirname):
+        directories = iglob(dirname, recursive, True)
+    else:
+        directories = [dirname]
+    for directory in directories:
+        if not os.path.isdir(directory or os.curdir):
+            continue
+        if recursive and basename == u"**":
+            for path in iter_tree(directory, directories_only):
+                # like glob, a relative ``**`` does not match the current
+                # directory but a relative ``**/*`` matches files in it
+                if path or directories_only:
+                    yield path
+        elif has_magic(basename):
+            hidden = basename.startswith(u".")
+            for name, is_directory in iter_directory(directory or os.curdir):
+                if (hidden or not name.startswith(u".")) and \
+                        (is_directory or not directories_only) and \
+                        fnmatch(name, basename):
+                    yield os.path.join(directory, name)
+        else:
+            path = os.path.join(directory, basename)
+            if os.path.lexists(path) and \
+                    (not directories_only or os.path.isdir(path)):
+                yield path
+
+def iter_tree(directory, directories_only=False):
+    """
+    Yields the given `directory`, with a trailing slash unless it is the
+    current directory ``""``, and every path below it which is not hidden,
+    reading one directory at a time.
+    """
+    yield os.path.join(directory, u"")
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            for name, is_directory in iter_directory(current or os.curdir):
+                if name.startswith(u"."):
+                    continue
+                path = os.path.join(current, name)
+                if is_directory:
+                    stack.append(path)
+                    yield path
+                elif not directories_only:
+                    yield path
+        except OSError:
+            continue
+
+class GlobPositional(Positional):
+    """
+    Represents a positional argument for a pattern which evaluates to an
+    iterator over the matching paths, see :func:`iglob`. Directories are
+    read only while iterating, one at a time.
+
+    If `variadic` is ``True`` the positional takes all remaining arguments
+    and evaluates to a single iterator over the matches of every pattern.
+    """
+    def __init__(self, metavar, variadic=False, recursive=True,
+                 short_description=None, long_description=None):
+        Positional.__init__(self, metavar,
+                            short_description=short_description,
+                            long_description=long_description)
+        self.takes_remaining = variadic
+        self.recursive = recursive
+
+    def evaluate(self, callpath, argument):
+        if self.takes_remaining:
+            return chain.from_iterable(
+                iglob(pattern, self.recursive) for pattern in argument
+            )
+        return iglob(argument, self.recursive)
+
+class StreamPositional(Positional):
+    """
+    Represents a positional argument which evaluates to an iterator over the
+    values read from stdin if ``-`` is given, each of which is evaluated
+    using the given ``sub_positional`` as it is consumed. Any other argument
+    evaluates to an iterator over that argument alone.
+
+    :param separator:
+        The byte seperating the values, a newline by default.
+
+    :param use_stdin:
+        If ``True`` stdin is read even if no argument is given.
+
+    :param stream:
+        The file-like object used instead of :data:`sys.stdin`.
+
+    :param encoding:
+        The encoding of the values, defaults to the encoding of the stream.
+    """
+    #: The number of bytes read at once.
+    chunk_size = 64 * 1024
+
+    def __init__(self, metavar, sub_positional=Positional, separator=b"\n",
+                 use_stdin=False, stream=None, encoding=None,
+                 short_description=None, long_description=None):
+        Positional.__init__(self, metavar,
+                            short_description=short_description,
+                            long_description=long_description)
+        self.sub_positional = sub_positional(metavar)
+        self.separator = separator
+        if use_stdin:
+            self.implicit_argument = u"-"
+        self.stream = stream
+        self.encoding = encoding
+
+    def evaluate(self, callpath, argument):
+        sub_positional_cp = callpath.extend(self.metavar,
+                                            self.sub_positional)
+        if argument == u"-":
+            return self.iter_values(sub_positional_cp)
+        return iter([
+            evaluate_node(self.sub_positional, sub_positional_cp, argument)
+        ])
+
+    def iter_values(self, callpath):
+        stream = sys.stdin if self.stream is None else self.stream
+        encoding = self.encoding or getattr(stream, "encoding", None) or \
+                sys.getdefaultencoding()
+        for value in iter_separated(stream, self.chunk_size, self.separator):
+            yield evaluate_node(self.sub_positional, callpath,
+                                value.decode(encoding))
+
+class CallPath(object):
+    """
+    An immutable path of ``(argument, node)`` pairs leading from the parser
+    to the node which is evaluated.
+
+    Extending a path creates a new path sharing the existing one, which is
+    never copied. A path can be iterated over and indexed like a list of
+    pairs, the list is only created when needed.
+    """
+    __slots__ = ("argument", "node", "parent", "length")
+
+    def __init__(self, argument, node, parent=None):
+        self.argument = argument
+        self.node = node
+        self.parent = parent
+        self.length = 1 if parent is None else parent.length + 1
+
+    @classmethod
+    def from_list(cls, pairs):
+        """
+        Returns a path of the given non-empty list of ``(argument, node)``
+        pairs, or `pairs` itself if it is already a :class:`CallPath`.
+        """
+        if isinstance(pairs, cls):
+            return pairs
+        pairs = iter(pairs)
+        result = cls(*pairs.next())
+        for argument, node in pairs:
+            result = cls(argument, node, result)
+        return result
+
+    def extend(self, argument, node):
+        """
+        Returns a new path ending with the given `argument` and `node`.
+        """
+        return CallPath(argument, node, self)
+
+    def replace(self, node):
+        """
+        Returns a new path with the node of the last pair replaced with the
+        given `node`.
+        """
+        return CallPath(self.argument, node, self.parent)
+
+    def to_list(self):
+        """
+        Returns a list of the ``(argument, node)`` pairs.
+        """
+        return list(reversed(list(reversed(self))))
+
+    def __add__(self, pairs):
+        result = self
+        for argument, node in pairs:
+            result = CallPath(argument, node, result)
+        return result
+
+    def __len__(self):
+        return self.length
+
+    def __reversed__(self):
+        path = self
+        while path is not None:
+            yield path.argument, path.node
+            path = path.parent
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_list()[index]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        path = self
+        for _ in xrange(self.length - index - 1):
+            path = path.parent
+        return path.argument, path.node
+
+    def __eq__(self, other):
+        if isinstance(other, (CallPath, list)):
+            return self.to_list() == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.to_list())
+
+def get_default(callpath, option):
+    """
+    Returns the default of the given `option` in the innermost command on the
+    given `callpath`.
+    """
+    for argument, node in reversed(callpath):
+        if isinstance(node, Command):
+            return node.defaults.get(option, option.default)
+    return option.default
+
+def is_loaded(command):
+    """
+    Returns ``False`` if the given `command` is a :class:`LazyCommand` which
+    has not been imported yet.
+    """
+    return not isinstance(command, LazyCommand) or \
+            command._command is not None
+
+def iter_commands(command):
+    """
+    Yields the given `command` and every command below it once, commands
+    which have not been imported yet are skipped.
+    """
+    seen = set()
+    stack = [command]
+    while stack:
+        command = stack.pop()
+        if id(command) in seen or not is_loaded(command):
+            continue
+        seen.add(id(command))
+        yield command
+        stack.extend(command.commands.itervalues())
+
+def get_option_attributes(obj):
+    return getmembers(obj, lambda x: isinstance(x, Option))
+
+def get_command_attributes(obj):
+    return getmembers(obj, lambda x: isinstance(x, Command))
+
+#: The kinds of checks, see :class:`ConstraintPlan`.
+REQUIRED = "required"
+ANY_REQUIRED = "any required"
+EXCLUSIVE = "exclusive"
+REQUIRES = "requires"
+CONFLICTS = "conflicts"
+
+def get_option_label(option):
+    """
+    Returns the label of the given `option` used in messages, like
+    ``"--force"`` or ``"-f"``.
+    """
+    if option.long is not None:
+        return u"--" + option.long
+    return u"-" + option.short
+
+def join_labels(labels):
+    return u", ".join(u"\"{0}\"".format(label) for label in labels)
+
+class Constraint(object):
+    """
+    Base class for constraints on the options with the given `names` of a
+    :class:`Command`, which are checked against the options given in the
+    arguments.
+    """
+    def __init__(self, *names):
+        if not names:
+            raise TypeError("a constraint needs at least one option")
+        self.names = names
+
+    def get_mask(self, bits, names=None):
+        """
+        Returns the bitmask of the options with the given `names`, all names
+        of the constraint by default, using the `bits` of the options.
+        """
+        mask = 0
+        for name in self.names if names is None else names:
+            try:
+                mask |= bits[name]
+            except KeyError:
+                raise ValueError("unknown option: {0!r}".format(name))
+        return mask
+
+    def compile(self, bits, labels):
+        """
+        Returns a list of checks, tuples of the kind of the check, a trigger
+        and a mask, as explained by :class:`ConstraintPlan`, and the message
+        reported if the check fails.
+
+        `bits` maps the option names to their bits and `labels` to their
+        labels used in messages.
+        """
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return "{0}({1})".format(self.__class__.__name__,
+                                 ", ".join(map(repr, self.names)))
+
+class Required(Constraint):
+    """
+    Requires every option with one of the given `names` to be given.
+    """
+    def compile(self, bits, labels):
+        return [(REQUIRED, 0, self.get_mask(bits, [name]),
+                 u"The option \"{0}\" is required.".format(labels[name]))
+                for name in self.names]
+
+class Exclusive(Constraint):
+    """
+    Allows at most one of the options with the given `names` to be given or,
+    if `required` is ``True``, exactly one.
+    """
+    def __init__(self, *names, **kwargs):
+        Constraint.__init__(self, *names)
+        self.required = kwargs.pop("required", False)
+        if kwargs:
+            raise TypeError("unexpected keyword arguments: {0}"
+                            .format(", ".join(kwargs)))
+
+    def compile(self, bits, labels):
+        mask = self.get_mask(bits)
+        names = join_labels(labels[name] for name in self.names)
+        checks = [(EXCLUSIVE, 0, mask, u"The options {0} are mutually "
+                   u"exclusive.".format(names))]
+        if self.required:
+            checks.append((ANY_REQUIRED, 0, mask, u"One of the options {0} "
+                           u"is required.".format(names)))
+        return checks
+
+class Requires(Constraint):
+    """
+    Requires the options with the given `names` to be given, if the option
+    with the given `name` is.
+    """
+    def __init__(self, name, *names):
+        Constraint.__init__(self, *names)
+        self.name = name
+
+    def compile(self, bits, labels):
+        return [(REQUIRES, self.get_mask(bits, [self.name]),
+                 self.get_mask(bits),
+                 u"The option \"{0}\" requires {1}.".format(
+                     labels[self.name],
+                     join_labels(labels[name] for name in self.names)
+                 ))]
+
+    def __repr__(self):
+        return "{0}({1})".format(self.__class__.__name__,
+                                 ", ".join(map(repr, (self.name, ) +
+                                                     self.names)))
+
+class Conflicts(Requires):
+    """
+    Forbids the options with the given `names` to be given, if the option
+    with the given `name` is.
+    """
+    def compile(self, bits, labels):
+        return [(CONFLICTS, self.get_mask(bits, [self.name]),
+                 self.get_mask(bits),
+                 u"The option \"{0}\" conflicts with {1}.".format(
+                     labels[self.name],
+                     join_labels(labels[name] for name in self.names)
+                 ))]
+
+class ConstraintPlan(object):
+    """
+    The given `constraints` on the options of the given `command` compiled
+    to bitmasks, each option is represented by a bit according to the
+    position of its name in the sorted names of the options.
+
+    Every check is a tuple of its kind, a trigger, a mask and a message. A
+    check applies if every option in the trigger is given and fails if the
+    options given in the mask are:
+
+    ``REQUIRED``
+        none, those checks are combined into a single mask.
+    ``ANY_REQUIRED``
+        none.
+    ``EXCLUSIVE``
+        more than one.
+    ``REQUIRES``
+        not all of them.
+    ``CONFLICTS``
+        any of them.
+    """
+    def __init__(self, command, constraints):
+        names = sorted(command.options)
+        #: Maps the option names to their bits.
+        self.bits = dict((name, 1 << i) for i, name in enumerate(names))
+        labels = dict((name, get_option_label(option))
+                      for name, option in command.options.iteritems())
+        #: The mask of the required options.
+        self.required = 0
+        #: A list of tuples of the bit of a required option and the message
+        #: reported if it is missing.
+        self.required_messages = []
+        #: The checks other than ``REQUIRED``.
+        self.checks = []
+        for constraint in constraints:
+            for check in constraint.compile(self.bits, labels):
+                kind, trigger, mask, message = check
+                if kind == REQUIRED:
+                    self.required |= mask
+                    self.required_messages.append((mask, message))
+                else:
+                    self.checks.append(check)
+
+    def get_violations(self, given):
+        """
+        Returns a list of messages for the failing checks, given the mask of
+        the `given` options.
+        """
+        violations = []
+        missing_required = self.required & ~given
+        if missing_required:
+            for bit, message in self.required_messages:
+                if missing_required & bit:
+                    violations.append(message)
+        for kind, trigger, mask, message in self.checks:
+            if given & trigger != trigger:
+                continue
+            selected = given & mask
+            if kind == EXCLUSIVE:
+                failed = selected & (selected - 1)
+            elif kind == ANY_REQUIRED:
+                failed = not selected
+            elif kind == REQUIRES:
+                failed = selected != mask
+            else:
+                failed = selected
+            if failed:
+                violations.append(message)
+        return violations
+
+    def __repr__(self):
+        return "{0}(required={1!r}, checks={2!r})".format(
+            self.__class__.__name__, self.required, self.checks
+        )
+
+class Command(Node):
+    """
+    Represents a command which unlike an option is not prefixed. A command can
+    have several options and/or commands.
+
+    Options or commands can be defined by passing them to the constructor in
+    a dictionary or by defining them declerativley on a subclass.
+
+    :param callback:
+        A function which get's called with the result of the evaluation instead
+        of returning it.
+    """
+    positionals = []
+
+    #: If ``True`` allows commands to be abbreviated e.g. you can pass ``he``
+    #: instead of ``help`` as long as there is no conflict with other commands.
+    allow_abbreviated_commands = True
+
+    #: The same as :attr:`allow_abbreviated_commands` for long options.
+    allow_abbreviated_options = True
+
+    #: If the command does not require any arguments additional to the options
+    #: and commands, set this to ``False``.
+    takes_arguments = True
+
+    #: If ``True`` a help command is added to this command.
+    use_auto_help = True
+
+    #: A :class:`Telemetry` counting the usage of this command.
+    telemetry = None
+
+    #: A list of :class:`Constraint` objects, like :class:`Exclusive`, on
+    #: the options given in the arguments, which are checked when the options
+    #: of this command are the result of the evaluation.
+    constraints = []
+
+    _constraint_plan = None
+
+    def __init__(self, options=None, commands=None, positionals=None,
+                 short_description=None, long_description=None, callback=None,
+                 allow_abbreviated_commands=None,
+                 allow_abbreviated_options=None,
+                 takes_arguments=None, constraints=None):
+        Node.__init__(self, short_description=short_description,
+                      long_description=long_description)
+        self.options = dict(get_option_attributes(self.__class__),
+                            **(options or {}))
+        self.commands = dict(get_command_attributes(self.__class__),
+                             **(commands or {}))
+        if positionals is not None:
+            self.positionals = positionals
+        #: Maps options to defaults overriding their own, see
+        #: :meth:`apply_defaults`.
+        self.defaults = {}
+        if self.use_auto_help:
+            self.commands.setdefault(u"help", help_command)
+        if callback is None or not hasattr(self, "callback"):
+            self.callback = callback
+        if allow_abbreviated_commands is not None:
+            self.allow_abbreviated_commands = allow_abbreviated_commands
+        if allow_abbreviated_options is not None:
+            self.allow_abbreviated_options = allow_abbreviated_options
+        if takes_arguments is not None:
+            self.takes_arguments = takes_arguments
+        if constraints is not None:
+            self.constraints = constraints
+
+    @property
+    def constraint_plan(self):
+        """
+        The :attr:`constraints` compiled to a :class:`ConstraintPlan` or
+        ``None`` if there are none.
+
+        The plan is created when it is needed first, call
+        :meth:`clear_constraint_plan` after changing the options or
+        constraints.
+        """
+        plan = self._constraint_plan
+        if plan is None and self.constraints:
+            plan = self._constraint_plan = ConstraintPlan(self,
+                                                          self.constraints)
+        return plan
+
+    def clear_constraint_plan(self):
+        """
+        Removes the :attr:`constraint_plan`, it is created again when needed.
+        """
+        self._constraint_plan = None
+
+    @property
+    def short_options(self):
+        """
+        A dictionary mapping the short variants of the options to a tuple of
+        the name of the option and the option itself.
+        """
+        result = {}
+        for name, option in self.options.iteritems():
+            if option.short is not None:
+                result[option.short] = (name, option)
+        return result
+
+    @property
+    def long_options(self):
+        """
+        A dictionary mapping the long variants of the options to a tuple of
+        the name of the option and the option itself.
+        """
+        long_options = {}
+        for name, option in self.options.iteritems():
+            if option.long is not None:
+                long_options[option.long] = (name, option)
+
+        if not self.allow_abbreviated_options:
+            return long_options
+        result = long_options.copy()
+        for abbr, long_option in abbreviations(long_options).iteritems():
+            result[abbr] = long_options[long_option]
+        return result
+
+    @property
+    def all_commands(self):
+        """
+        A dictionary mapping the command names (including abbreviations) to a
+        tuple of the complete command name and the command itself.
+        """
+        commands = dict((k, (k, v)) for k, v in self.commands.iteritems())
+        if not self.allow_abbreviated_commands:
+            return commands.copy()
+        for abbr, command in abbreviations(commands).iteritems():
+            commands[abbr] = commands[command]
+        return commands
+
+    def apply_defaults(self, defaults):
+        """
+        Applies the given nested dictionary of `defaults`, mapping option
+        names to default values and command names to dictionaries of their
+        own.
+
+        The defaults are stored on this command and do not change the options
+        themselves so options can be shared by several commands.
+        """
+        for key, value in defaults.iteritems():
+            try:
+                command = self.commands[key]
+            except KeyError:
+                self.defaults[self.options[key]] = value
+            else:
+                command.apply_defaults(value)
+
+    def get_default(self, name):
+        """
+        Returns the default of the option with the given `name`.
+        """
+        option = self.options[name]
+        return self.defaults.get(option, option.default)
+
+    def get_usage(self, callpath):
+        result = [u'usage: {0}'.format(u' '.join(map(itemgetter(0), callpath)))]
+        if self.options:
+            result.append(u'[options]')
+        if len(self.commands) > 1 or \
+                self.commands and u'help' not in self.commands:
+            result.append(u'[commands]')
+        for positional in self.positionals:
+            result.append(positional.metavar)
+        return u' '.join(result)
+
+    def print_missing_node(self, node, callpath):
+        if self.telemetry is not None:
+            self.telemetry.count(self, ERROR, u"unknown {0}".format(
+                u"option" if node.startswith(u"-") else u"command"
+            ))
+        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
+        write(self.get_usage([(argument, n) for argument, n in callpath
+                              if isinstance(n, Command)]))
+        if node.startswith(u"-"):
+            type = u"option"
+            possible_items = [option.long for option in self.options.values()
+                              if option.long is not None]
+        else:
+            type = u"command"
+            possible_items = self.commands.keys()
+        write(u'')
+        for shorter_version in shorter(node.strip(u'-')):
+            items = list(matches(shorter_version, possible_items))
+            if items:
+                break
+        else:
+            items = list(matches(node.strip(u'-'), possible_items))
+        locations = self.get_node_locations(node, callpath)
+        if locations:
+            locations = u"\"{0}\" is {1} of \"{2}\".".format(
+                node, u"an option" if type == u"option" else u"a command",
+                u"\", \"".join(locations)
+            )
+        if not items:
+            write(u"The given {0} \"{1}\" does not exist.".format(type, node))
+            if locations:
+                write(locations)
+            sys.exit(1)
+        write(u"The given {0} \"{1}\" does not exist, did you mean?" \
+                .format(type, node))
+        for item in items:
+            item = u'-' * node[:2].count(u'-') + item
+            write(u" - {0}".format(item))
+        write(u"")
+        if locations:
+            write(locations)
+            write(u"")
+        sys.exit(1)
+
+    def get_node_locations(self, node, callpath, limit=5):
+        """
+        Returns the usage prefixes, like ``"tool push"``, of up to `limit`
+        commands which have the given option or command `node`, looked up in
+        the :attr:`Parser.node_index` of the parser on the `callpath`.
+        """
+        root = callpath[0][1]
+        index = getattr(root, "node_index", None)
+        if index is None:
+            return []
+        return [u" ".join((root.script_name, ) + path)
+                for path in index.get(node, [])[:limit]]
+
+    def evaluate(self, callpath, arguments):
+        """
+        Evaluates the given ``arguments`` and returns a dictionary with the
+        options and a list with remaining arguments.
+
+        ``arguments`` may be any iterable or a :class:`TokenStream`, it is
+        consumed lazily. Any arguments following ``--`` are remaining
+        arguments, even if they look like options or commands.
+
+        Commands overriding this method are called with a list of the
+        arguments following them.
+        """
+        callpath = CallPath.from_list(callpath)
+        telemetry = self.telemetry
+        if telemetry is not None and not telemetry.sample():
+            telemetry = None
+        constraint_plan = self.constraint_plan
+        given = 0
+        options = self.create_options()
+        result = options, []
+        tokens = tokenize(arguments)
+        for kind, value, argument in tokens:
+            if telemetry is not None and \
+                    (kind == LONG_OPTION or kind == SHORT_OPTIONS):
+                telemetry.count(self, OPTION, argument)
+            if kind == LONG_OPTION:
+                name = self.evaluate_long_option(
+                    callpath.extend(argument, None), value, tokens, options
+                )
+                if constraint_plan is not None:
+                    given |= constraint_plan.bits[name]
+            elif kind == SHORT_OPTIONS:
+                names = self.evaluate_short_options(
+                    callpath.extend(argument, None), value, tokens, options
+                )
+                if constraint_plan is not None:
+                    for name in names:
+                        given |= constraint_plan.bits[name]
+            elif kind == TERMINATOR:
+                result = options, list(tokens.rest())
+                if result[1] and not self.takes_arguments:
+                    self.print_missing_node(result[1][0], callpath)
+                    return
+                break
+            else:
+                try:
+                    name, command = self.all_commands[argument]
+                except KeyError:
+                    if not self.takes_arguments:
+                        self.print_missing_node(argument, callpath)
+                        return
+                    result = options, [argument]
+                    result[1].extend(tokens.rest())
+                    break
+                if telemetry is not None:
+                    telemetry.count(self, COMMAND, name)
+                result = command.evaluate(callpath.extend(argument, command),
+                                          get_command_arguments(command,
+                                                                tokens))
+                if self.callback is not None:
+                    self.call_callback(result)
+                return {name: result}, []
+        if constraint_plan is not None:
+            violations = constraint_plan.get_violations(given)
+            if violations:
+                self.print_constraint_violations(violations, callpath)
+        if self.positionals:
+            self.evaluate_positionals(callpath, result[1])
+        return result
+
+    def call_callback(self, result):
+        """
+        Calls the callback with the given `result` of evaluating a command
+        and closes the files in the result afterwards.
+        """
+        try:
+            self.callback(*result)
+        finally:
+            close_files(result)
+
+    def create_options(self):
+        """
+        Returns the dictionary the options are evaluated into, containing the
+        defaults and the containers of accumulating options.
+        """
+        options = {}
+        defaults = self.defaults
+        for name, option in self.options.iteritems():
+            default = defaults.get(option, option.default)
+            if option.accumulates:
+                options[name] = option.create_container(default)
+            elif default is not missing:
+                options[name] = default
+        return options
+
+    def evaluate_positionals(self, callpath, arguments):
+        """
+        Replaces the given remaining ``arguments`` with the results of
+        evaluating them using the corresponding positionals.
+        """
+        for i, positional in enumerate(self.positionals):
+            if positional.takes_remaining:
+                arguments[i:] = [positional.evaluate(
+                    callpath.extend(positional.metavar, positional),
+                    arguments[i:]
+                )]
+                break
+            if i < len(arguments):
+                argument = arguments[i]
+            elif positional.implicit_argument is not missing:
+                argument = positional.implicit_argument
+                arguments.append(argument)
+            else:
+                break
+            arguments[i] = evaluate_node(
+                positional, callpath.extend(positional.metavar, positional),
+                argument
+            )
+
+    def print_unexpected_argument(self, callpath):
+        if self.telemetry is not None:
+            self.telemetry.count(self, ERROR, u"unexpected argument")
+        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
+        write(self.get_usage([(argument, n) for argument, n in callpath
+                              if isinstance(n, Command)]))
+        write(u"")
+        write(u"The given option \"{0}\" does not take an argument."
+              .format(callpath.argument.partition(u"=")[0]))
+        sys.exit(1)
+
+    def print_constraint_violations(self, violations, callpath):
+        if self.telemetry is not None:
+            self.telemetry.count(self, ERROR, u"constraint violation")
+        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
+        write(self.get_usage([(argument, n) for argument, n in callpath
+                              if isinstance(n, Command)]))
+        write(u"")
+        for violation in violations:
+            write(violation)
+        sys.exit(1)
+
+    def evaluate_short_options(self, callpath, shorts, tokens, options):
+        """
+        Evaluates the options with the given `shorts` and returns a list of
+        their names.
+        """
+        short_options = self.short_options
+        names = []
+        for short in shorts:
+            try:
+                name, option = short_options[short]
+            except KeyError:
+                self.print_missing_node(u"-" + short, callpath)
+            self.evaluate_option(callpath.replace(option), name, option,
+                                 tokens, options)
+            names.append(name)
+        return names
+
+    def evaluate_long_option(self, callpath, long, tokens, options):
+        """
+        Evaluates the option with the given `long` variant and returns its
+        name.
+        """
+        try:
+            name, option = self.long_options[long]
+        except KeyError:
+            self.print_missing_node(u"--" + long, callpath)
+        self.evaluate_option(callpath.replace(option), name, option, tokens,
+                             options)
+        return name
+
+    def evaluate_option(self, callpath, name, option, tokens, options):
+        """
+        Evaluates the given `option`, taking an argument from the `tokens`
+        stream if necessary, and stores the value in the `options`
+        dictionary under the given `name`.
+        """
+        argument = tokens.pop_attached_value()
+        if option.requires_argument:
+            if argument is missing:
+                argument = tokens.next_argument()
+            value = evaluate_node(option, callpath, argument)
+        elif option.allows_optional_argument:
+            if argument is missing:
+                try:
+                    argument = tokens.next_argument()
+                except StopIteration:
+                    pass
+            if argument is missing:
+                value = option.evaluate(callpath)
+            else:
+                value = evaluate_node(option, callpath, argument)
+        else:
+            if argument is not missing:
+                self.print_unexpected_argument(callpath)
+            value = option.evaluate(callpath)
+        if option.accumulates:
+            options[name] = option.accumulate(options[name], value)
+        else:
+            options[name] = value
+
+    def __getattr__(self, name):
+        if name.startswith(u"__"):
+            raise AttributeError(name)
+        for d in [self.commands, self.options]:
+            try:
+                return d[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return ("{0}(options={1!r}, commands={2!r}, short_description={2!r}, "
+                "long_description={3!r}, callback={4!r})"). \
+                        format(self.__class__.__name__, self.options,
+                               self.commands, self.short_description,
+                               self.long_description, self.callback)
+
+def inherits_evaluate(command):
+    """
+    Returns ``True`` if the given `command` uses :meth:`Command.evaluate`.
+    """
+    return _inherits(command, Command, ["evaluate"])
+
+def get_command_arguments(command, tokens):
+    """
+    Returns the arguments the given `command` is evaluated with: the
+    `tokens` themselves if it uses :meth:`Command.evaluate`, otherwise a
+    list of the remaining arguments, which is what an overridden
+    :meth:`Command.evaluate` expects.
+    """
+    if inherits_evaluate(command):
+        return tokens
+    return list(tokens.rest())
+
+class HelpCommand(Command):
+    use_auto_help = False
+
+    def __init__(self, options=None, commands=None,
+                 short_description=u"Shows this message.",
+                 long_description=u"Shows help messages.",
+                 callback=None,
+                 allow_abbreviated_commands=None,
+                 allow_abbreviated_options=None):
+        Command.__init__(self, options=options, commands=commands,
+                         short_description=short_description,
+                         long_description=long_description, callback=callback,
+                         allow_abbreviated_commands=allow_abbreviated_commands,
+                         allow_abbreviated_options=allow_abbreviated_options)
+
+    def evaluate(self, callpath, arguments):
+        def get_node(node, argument, d):
+            try:
+                node = d[node][1]
+            except KeyError:
+                command.print_missing_node(argument, callpath)
+            return node
+
+        callpath = CallPath.from_list(callpath)
+        command = callpath.parent.node
+        try:
+            argument = arguments[0]
+        except IndexError:
+            node = command
+            callpath = callpath.parent
+        else:
+            if argument.startswith(u'--'):
+                node = get_node(
+                    argument[2:],
+                    argument,
+                    command.long_options,
+                )
+                argument = argument[2:]
+            if argument.startswith(u'-'):
+                node = get_node(
+                    argument[1:],
+                    argument,
+                    command.short_options,
+                )
+                argument = argument[1:]
+            else:
+                node = get_node(
+                    argument,
+                    argument,
+                    command.all_commands,
+                )
+            callpath = callpath.parent.extend(argument, None)
+
+        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
+        write(node.get_usage(callpath))
+        write(u"")
+        write(node.long_description)
+        write(u"")
+        if not isinstance(node, Command):
+            sys.exit(1)
+        commands = sorted(node.commands.items(),
+                          key=lambda x: x[1]._position_hint)
+        options = sorted(node.options.values(),
+                         key=attrgetter("_position_hint"))
+        nodes = []
+        get_length = lambda nodes: max(10, max(len(n[0]) for n in nodes))
+        if commands:
+            nodes.append((u"Commands:", get_length(commands), commands))
+        if options:
+            option_nodes = []
+            for option in options:
+                if option.short is None:
+                    option_nodes.append(
+                        (u'--{0}'.format(option.long), option)
+                    )
+                elif option.long is None:
+                    option_nodes.append(
+                        (u'-{0}'.format(option.short), option)
+                    )
+                else:
+                    option_nodes.append((
+                        u'-{0} --{1}'.format(
+                            option.short, option.long
+                        ),
+                        option
+                    ))
+            nodes.append((u"Options:", get_length(option_nodes), option_nodes))
+        if getattr(node, 'positionals', False):
+            positional_nodes = [(p.metavar, p) for p in node.positionals]
+            nodes.append((
+                u"Positional arguments:",
+                get_length(positional_nodes),
+                positional_nodes
+            ))
+        for label, max_node_length, nodes in nodes:
+            write(label)
+            for node_name, node in nodes:
+                write(u" {0} {1}".format(node_name.ljust(max_node_length),
+                                         node.short_description))
+            write("")
+        sys.exit(1)
+
+#: The help command added to every command using :attr:`Command.use_auto_help`,
+#: it is stateless so a single instance is shared and always listed last.
+help_command = HelpCommand()
+help_command._position_hint = sys.maxint
+
+class Parser(Command):
+    """
+    Represents the command which is evaluated with the arguments given to
+    the script.
+
+    A parser may be used by several threads at once, every evaluation keeps
+    its state to itself and the caches shared by evaluations are locked.
+    Changing the parser while it is used is not safe.
+    """
+    #: If ``True`` an argument like ``@path`` is replaced with the arguments
+    #: in the file at ``path``, one per line or seperated by NUL bytes.
+    allow_response_files = False
+
+    #: The number of bytes read at once from a response file.
+    response_file_chunk_size = 64 * 1024
+
+    #: The maximum number of lines for which :meth:`evaluate_line` caches the
+    #: arguments and the plan of their evaluation.
+    line_cache_size = 256
+
+    def __init__(self, options=None, commands=None, positionals=None,
+                 script_name=None, description=None, out_file=sys.stdout,
+                 takes_arguments=None, defaults=None, config=None,
+                 allow_response_files=None, constraints=None):
+        Command.__init__(self, options=options, commands=commands,
+                         positionals=positionals,
+                         long_description=description,
+                         takes_arguments=takes_arguments,
+                         constraints=constraints)
+        if allow_response_files is not None:
+            self.allow_response_files = allow_response_files
+        self.script_name = sys.argv[0] if script_name is None else script_name
+        self.out_file = out_file
+        self._line_cache = OrderedDict()
+        self._line_cache_lock = threading.Lock()
+        self._node_index = None
+        if defaults is not None:
+            self.apply_defaults(defaults)
+        if config is not None:
+            config.apply(self)
+
+    @property
+    def out_file(self):
+        """
+        A file-like object to which any output is being written.
+        """
+        return self._out_file
+
+    @out_file.setter
+    def out_file(self, fobj):
+        if isinstance(fobj, codecs.StreamReaderWriter):
+            self._out_file = fobj
+            return
+        encoding = getattr(fobj, "encoding", None)
+        if encoding is None:
+            encoding = "ascii"
+            errors = "replace"
+        else:
+            errors = "strict"
+        codec_info = codecs.lookup(encoding)
+        self._out_file = codecs.StreamReaderWriter(fobj,
+                                                   codec_info.streamreader,
+                                                   codec_info.streamwriter,
+                                                   errors)
+
+    def compile(self):
+        """
+        Returns a :class:`CompiledParser` for this parser.
+        """
+        return CompiledParser(self)
+
+    def incremental(self):
+        """
+        Returns an :class:`IncrementalParser` for this parser.
+        """
+        return IncrementalParser(self)
+
+    def snapshot(self):
+        """
+        Returns a copy of this parser without any callbacks and telemetry,
+        which can be pickled as long as the nodes can be.
+        """
+        memo = {}
+        for command in iter_commands(self):
+            if command.callback is not None:
+                memo[id(command.callback)] = None
+            if command.telemetry is not None:
+                memo[id(command.telemetry)] = None
+        result = copy.deepcopy(self, memo)
+        result.out_file = self.out_file
+        return result
+
+    def evaluate_records(self, records, processes=None, ordered=True,
+                         chunksize=64):
+        """
+        Evaluates the given `records` in a pool of `processes` and yields a
+        tuple of the arguments, the result and ``None`` for each record or, if
+        the evaluation failed, of the arguments, ``None`` and the error
+        message.
+
+        `records` may be a file or any iterable, each record is a list of
+        arguments or a line which is split like :meth:`evaluate_line` does.
+        The results are yielded in the order of the records or, if `ordered`
+        is ``False``, as soon as they are available.
+
+        Each process receives a pickled :meth:`snapshot` of this parser once,
+        callbacks are therefore not called. Records are sent to the processes
+        in chunks of `chunksize` records and only a limited number of chunks
+        is pending at any time, so the records may be read from a stream of
+        any length.
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        snapshot = pickle.dumps(self.snapshot(), pickle.HIGHEST_PROTOCOL)
+        pending = threading.Semaphore(processes * chunksize * 4)
+        stopped = threading.Event()
+        def bounded_records():
+            for record in records:
+                pending.acquire()
+                if stopped.is_set():
+                    return
+                yield record
+        pool = multiprocessing.Pool(processes, initialize_record_worker,
+                                    (snapshot, ))
+        try:
+            imap = pool.imap if ordered else pool.imap_unordered
+            for result in imap(evaluate_record, bounded_records(), chunksize):
+                pending.release()
+                yield result
+        finally:
+            # the pool waits for the thread taking the records, which may be
+            # waiting for results to be taken
+            stopped.set()
+            pending.release()
+            pool.terminate()
+            pool.join()
+
+    def evaluate_columnar(self, records, processes=None, chunksize=64):
+        """
+        Evaluates the given `records` like :meth:`evaluate_records` and
+        returns the results as :class:`ColumnarResults`.
+        """
+        results = ColumnarResults(self)
+        for arguments, result, error in self.evaluate_records(
+                records, processes=processes, chunksize=chunksize):
+            results.append(result, error)
+        return results
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_out_file"]
+        del state["_line_cache_lock"]
+        state["_line_cache"] = OrderedDict()
+        state["_node_index"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._line_cache_lock = threading.Lock()
+        self.out_file = sys.stdout
+
+    def evaluate(self, arguments=None):
+        """
+        Evaluates the given list of ``arguments`` and returns a dictionary with
+        the options and a list with the remaining arguments.
+        """
+        if arguments is None:
+            arguments = sys.argv[1:]
+        arguments = decode_arguments(arguments)
+        if self.allow_response_files:
+            arguments = self.expand_response_files(arguments)
+        if self.telemetry is None:
+            return Command.evaluate(self, CallPath(self.script_name, self),
+                                    arguments)
+        try:
+            return Command.evaluate(self, CallPath(self.script_name, self),
+                                    arguments)
+        except Exception as error:
+            self.telemetry.count(self, ERROR, error.__class__.__name__)
+            raise
+
+    def evaluate_line(self, line):
+        """
+        Splits the given `line` into arguments like a POSIX shell and
+        evaluates them like :meth:`evaluate`.
+
+        The arguments and a plan of their evaluation with every option and
+        command looked up are cached for the most recently evaluated lines,
+        so evaluating a line again only calls the converters and callbacks.
+        Call :meth:`clear_line_cache` after changing the parser.
+        """
+        line = line.strip()
+        with self._line_cache_lock:
+            cached = self._line_cache.pop(line, None)
+            if cached is not None:
+                self._line_cache[line] = cached
+        if cached is None:
+            arguments = decode_arguments(split_line(line))
+            plan = None
+            if not self.allow_response_files:
+                try:
+                    plan = plan_command(self, tokenize(arguments), Parser)
+                except Fallback:
+                    pass
+            cached = arguments, plan
+            with self._line_cache_lock:
+                self._line_cache[line] = cached
+                if len(self._line_cache) > self.line_cache_size:
+                    self._line_cache.popitem(last=False)
+        arguments, plan = cached
+        if plan is None:
+            return self.evaluate(arguments)
+        return plan.execute(CallPath(self.script_name, self))
+
+    @property
+    def node_index(self):
+        """
+        A dictionary mapping every option, like ``--force`` and ``-f``, and
+        every command of this parser and the commands below it to a sorted
+        list of the paths of the commands they belong to, tuples of command
+        names.
+
+        The index is created when it is needed first, call
+        :meth:`clear_node_index` after changing the parser.
+        """
+        index = self._node_index
+        if index is None:
+            index = {}
+            stack = [((), self, frozenset([id(self)]))]
+            while stack:
+                path, command, ancestors = stack.pop()
+                for option in command.options.itervalues():
+                    if option.long is not None:
+                        index.setdefault(u"--" + option.long, []).append(path)
+                    if option.short is not None:
+                        index.setdefault(u"-" + option.short, []).append(path)
+                for name, subcommand in command.commands.iteritems():
+                    index.setdefault(name, []).append(path)
+                    if id(subcommand) in ancestors or \
+                            not is_loaded(subcommand):
+                        continue
+                    stack.append((path + (name, ), subcommand,
+                                  ancestors | frozenset([id(subcommand)])))
+            for paths in index.itervalues():
+                paths.sort()
+            self._node_index = index
+        return index
+
+    def clear_node_index(self):
+        """
+        Removes the :attr:`node_index`, it is created again when needed.
+        """
+        self._node_index = None
+
+    def clear_line_cache(self):
+        """
+        Removes every line cached by :meth:`evaluate_line`.
+        """
+        with self._line_cache_lock:
+            self._line_cache.clear()
+
+    def expand_response_files(self, arguments,
+            encoding=sys.stdin.encoding or sys.getdefaultencoding()):
+        """
+        Yields the given ``arguments`` replacing every ``@path`` argument with
+        the arguments in the file at ``path`` which are read lazily in chunks
+        and decoded using the given ``encoding``.
+        """
+        for argument in arguments:
+            if not argument.startswith(u"@") or argument == u"@":
+                yield argument
+                continue
+            try:
+                response_file = open(argument[1:], "rb")
+            except IOError:
+                write = lambda x: self.out_file.write(x + u"\n")
+                write(self.get_usage([(self.script_name, self)]))
+                write(u"")
+                write(u"The given response file \"{0}\" could not be read."
+                      .format(argument[1:]))
+                sys.exit(1)
+            with response_file:
+                for item in iter_separated(response_file,
+                                           self.response_file_chunk_size):
+                    yield item.decode(encoding)
+
+    def __repr__(self):
+        return "{0}(script_name={1!r}, description={2!r})" \
+                .format(self.__class__.__name__, self.script_name,
+                        self.long_description)
+
+#: Maps the absolute paths of configuration files to a tuple of the stamp of
+#: the file, as returned by :func:`get_file_stamp`, and the parsed content.
+_config_cache = {}
+
+_boolean_states = {
+    u"1": True, u"yes": True, u"true": True, u"on": True,
+    u"0": False, u"no": False, u"false": False, u"off": False
+}
+
+def get_file_stamp(path):
+    """
+    Returns a tuple of the modification time and the size of the file at the
+    given `path` or ``None`` if the file does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+def is_ini_file(path):
+    return not path.endswith(u".json")
+
+def parse_config_file(path, section):
+    """
+    Parses the configuration file at the given `path` and returns a nested
+    dictionary suitable for :meth:`Command.apply_defaults`.
+
+    JSON files are expected to contain such a dictionary, the values in INI
+    files are taken from the given `section` and sections like
+    ``[section.command.subcommand]`` for the commands.
+    """
+    if not is_ini_file(path):
+        with open(path, "rb") as f:
+            return json.load(f)
+    parser = RawConfigParser()
+    parser.optionxform = unicode
+    with codecs.open(path, "r", "utf-8") as f:
+        parser.readfp(f)
+    result = {}
+    prefix = section + u"."
+    for name in parser.sections():
+        if name == section:
+            path = []
+        elif name.startswith(prefix):
+            path = name[len(prefix):].split(u".")
+        else:
+            continue
+        defaults = result
+        for command in path:
+            defaults = defaults.setdefault(command, {})
+        defaults.update(parser.items(name))
+    return result
+
+def merge_defaults(target, source):
+    """
+    Merges the nested defaults dictionary `source` into `target`.
+    """
+    for key, value in source.iteritems():
+        if isinstance(value, dict) and isinstance(target.get(key, {}), dict):
+            merge_defaults(target.setdefault(key, {}), value)
+        else:
+            target[key] = value
+
+def evaluate_ini_defaults(command, defaults, callpath):
+    """
+    Evaluates the strings taken from an INI file with the options they are
+    defaults for. The values of accumulating options are separated by
+    commas, like ``foo, bar``, those of accumulating options without an
+    argument, like :class:`CountOption`, are integers.
+    """
+    result = {}
+    for key, value in defaults.iteritems():
+        try:
+            subcommand = command.commands[key]
+        except KeyError:
+            option = command.options[key]
+            if option.accumulates and option.requires_argument:
+                option_callpath = callpath.extend(key, option)
+                container = option.create_container(missing)
+                for item in parse_multiple(value):
+                    container = option.accumulate(
+                        container,
+                        option.evaluate(option_callpath, item.strip())
+                    )
+                value = container
+            elif option.accumulates and not option.allows_optional_argument:
+                value = option.create_container(int(value))
+            elif option.requires_argument or option.allows_optional_argument:
+                value = option.evaluate(callpath.extend(key, option), value)
+            else:
+                try:
+                    value = _boolean_states[value.lower()]
+                except KeyError:
+                    raise ValueError("not a boolean: {0!r}".format(value))
+        else:
+            value = evaluate_ini_defaults(subcommand, value,
+                                          callpath.extend(key, subcommand))
+        result[key] = value
+    return result
+
+class ConfigSource(object):
+    """
+    Provides defaults for a :class:`Command` from configuration files.
+
+    :param paths:
+        A list of paths to INI or JSON files, values in later files override
+        those in earlier ones. Files which do not exist are ignored so you can
+        pass system, user and project configuration files alike.
 
-def get_command_attributes(obj):
-    return getmembers(obj, lambda x: isinstance(x, Command))
+    :param section:
+        The INI section containing the defaults for the options of the parser
+        itself, defaults for commands are taken from sections like
+        ``[opts.command.subcommand]``.
 
-class Command(Node):
+    :param cache_file:
+        The path of a file in which parsed configuration files are cached
+        across invocations.
+
+    Parsed files are cached by path, modification time and size, so unchanged
+    files are parsed at most once per process or, given a `cache_file`, only
+    once at all.
     """
-    Represents a command which unlike an option is not prefixed. A command can
-    have several options and/or commands.
+    def __init__(self, paths, section=u"opts", cache_file=None):
+        self.paths = paths
+        self.section = section
+        self.cache_file = cache_file
 
-    Options or commands can be defined by passing them to the constructor in
-    a dictionary or by defining them declerativley on a subclass.
+    def read_cache_file(self):
+        try:
+            with open(self.cache_file, "rb") as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return {}
 
-    :param callback:
-        A function which get's called with the result of the evaluation instead
-        of returning it.
-    """
-    positionals = []
+    def write_cache_file(self, entries):
+        tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, "wb") as f:
+                marshal.dump(entries, f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            # the files are parsed again next time
+            pass
 
-    #: If ``True`` allows commands to be abbreviated e.g. you can pass ``he``
-    #: instead of ``help`` as long as there is no conflict with other commands.
-    allow_abbreviated_commands = True
+    def load(self):
+        """
+        Returns a list of tuples containing the path and the parsed content of
+        every existing configuration file.
+        """
+        result = []
+        disk_cache = missing
+        changed = False
+        for path in self.paths:
+            path = os.path.abspath(path)
+            stamp = get_file_stamp(path)
+            if stamp is None:
+                continue
+            key = path, self.section
+            cached = _config_cache.get(key)
+            if cached is None or cached[0] != stamp:
+                if self.cache_file is not None and disk_cache is missing:
+                    disk_cache = self.read_cache_file()
+                cached = disk_cache.get(key) if disk_cache else None
+                if cached is None or cached[0] != stamp:
+                    cached = stamp, parse_config_file(path, self.section)
+                    changed = True
+                _config_cache[key] = cached
+            result.append((path, cached[1]))
+        if changed and self.cache_file is not None:
+            entries = self.read_cache_file() if disk_cache is missing \
+                    else disk_cache
+            for path, content in result:
+                key = path, self.section
+                entries[key] = _config_cache[key]
+            self.write_cache_file(entries)
+        return result
 
-    #: The same as :attr:`allow_abbreviated_commands` for long options.
-    allow_abbreviated_options = True
+    def get_defaults(self, command):
+        """
+        Returns the merged defaults for the given `command`.
+        """
+        callpath = CallPath(getattr(command, "script_name", u""), command)
+        result = {}
+        for path, content in self.load():
+            if is_ini_file(path):
+                content = evaluate_ini_defaults(command, content, callpath)
+            merge_defaults(result, content)
+        return result
 
-    #: If the command does not require any arguments additional to the options
-    #: and commands, set this to ``False``.
-    takes_arguments = True
+    def apply(self, command):
+        """
+        Applies the defaults from the configuration files to the given
+        `command`.
+        """
+        command.apply_defaults(self.get_defaults(command))
 
-    #: If ``True`` a help command is added to this command.
-    use_auto_help = True
+    def __repr__(self):
+        return "{0}({1!r}, section={2!r}, cache_file={3!r})".format(
+            self.__class__.__name__, self.paths, self.section, self.cache_file
+        )
 
-    def __init__(self, options=None, commands=None, positionals=None,
-                 short_description=None, long_description=None, callback=None,
-                 allow_abbreviated_commands=None,
-                 allow_abbreviated_options=None,
-                 takes_arguments=None):
+def load_command(name):
+    """
+    Imports the object with the given `name`, see :func:`import_object`,
+    and returns it if it is a command, an instance if it is a command class
+    or the result of calling it otherwise.
+    """
+    obj = import_object(name)
+    if isinstance(obj, type) and issubclass(obj, Command):
+        return obj()
+    elif not isinstance(obj, Command):
+        return obj()
+    return obj
+
+class LazyCommand(Command):
+    """
+    A command which is imported from the object with the given `name`, see
+    :func:`load_command`, once it is evaluated or anything but the given
+    descriptions is needed. Descriptions which are not given are those of
+    the imported command.
+    """
+    _command = None
+    _telemetry = None
+
+    def __init__(self, name, short_description=None, long_description=None):
         Node.__init__(self, short_description=short_description,
                       long_description=long_description)
-        self.options = dict(get_option_attributes(self.__class__),
-                            **(options or {}))
-        self.commands = dict(get_command_attributes(self.__class__),
-                             **(commands or {}))
-        if positionals is not None:
-            self.positionals = positionals
-        if self.use_auto_help:
-            self.commands.setdefault(u"help", HelpCommand())
-        if callback is None or not hasattr(self, "callback"):
-            self.callback = callback
-        if allow_abbreviated_commands is not None:
-            self.allow_abbreviated_commands = allow_abbreviated_commands
-        if allow_abbreviated_options is not None:
-            self.allow_abbreviated_options = allow_abbreviated_options
-        if takes_arguments is not None:
-            self.takes_arguments = takes_arguments
+        self.name = name
 
     @property
-    def short_options(self):
+    def command(self):
         """
-        A dictionary mapping the short variants of the options to a tuple of
-        the name of the option and the option itself.
+        The imported command.
         """
-        result = {}
-        for name, option in self.options.iteritems():
-            result[option.short] = (name, option)
-        return result
+        if self._command is None:
+            command = load_command(self.name)
+            if self._telemetry is not None:
+                self._telemetry.install(command,
+                                        self._telemetry.get_path(self))
+            self._command = command
+        return self._command
 
     @property
-    def long_options(self):
+    def short_description(self):
+        description = self._resolve_description("_short_description")
+        if description is None:
+            return self.command.short_description
+        return description
+
+    @short_description.setter
+    def short_description(self, short_description):
+        self._short_description = short_description
+
+    @property
+    def long_description(self):
+        description = self._resolve_description("_long_description")
+        if description is None:
+            return self.command.long_description
+        return description
+
+    @long_description.setter
+    def long_description(self, long_description):
+        self._long_description = long_description
+
+    options = property(lambda self: self.command.options)
+    commands = property(lambda self: self.command.commands)
+    positionals = property(lambda self: self.command.positionals)
+    defaults = property(lambda self: self.command.defaults)
+    callback = property(lambda self: self.command.callback)
+    takes_arguments = property(lambda self: self.command.takes_arguments)
+
+    @property
+    def telemetry(self):
+        if self._command is None:
+            return self._telemetry
+        return self._command.telemetry
+
+    @telemetry.setter
+    def telemetry(self, telemetry):
+        self._telemetry = telemetry
+        if self._command is not None:
+            self._command.telemetry = telemetry
+
+    constraints = property(lambda self: self.command.constraints)
+
+    def evaluate(self, callpath, arguments):
+        command = self.command
+        return command.evaluate(CallPath.from_list(callpath).replace(command),
+                                arguments)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_command", None)
+        state.pop("_telemetry", None)
+        return state
+
+    def __repr__(self):
+        return "{0}({1!r}, short_description={2!r})".format(
+            self.__class__.__name__, self.name, self._short_description
+        )
+
+#: A command discovered by a :class:`PluginRegistry`.
+PluginEntry = namedtuple("PluginEntry", ["name", "import_name"])
+
+#: The suffixes of the entries in the directories on :data:`sys.path`
+#: describing installed distributions.
+_distribution_suffixes = (".dist-info", ".egg-info", ".egg-link", ".egg",
+                          ".pth")
+
+class PluginRegistry(object):
+    """
+    Discovers commands registered by installed distributions as entry
+    points in the given `group` and adds them to commands as
+    :class:`LazyCommand`, so the module providing a command is only imported
+    if the command is used.
+
+    Discovering the commands requires :mod:`pkg_resources`, the names and
+    import names are cached in the `cache_file` until distributions are
+    installed or removed. By default the cache file is stored in
+    ``$XDG_CACHE_HOME/opts`` or ``~/.cache/opts``. The descriptions are
+    those of the imported commands, so listing the commands in the help
+    imports them.
+    """
+    def __init__(self, group, cache_file=None):
+        self.group = group
+        if cache_file is None:
+            cache_file = os.path.join(
+                os.environ.get("XDG_CACHE_HOME") or
+                    os.path.join(os.path.expanduser("~"), ".cache"),
+                "opts", "plugins-{0}".format(group)
+            )
+        self.cache_file = cache_file
+        self._entries = None
+
+    def get_environment_stamp(self):
         """
-        A dictionary mapping the long variants of the options to a tuple of
-        the name of the option and the option itself.
+        Returns a value which changes if distributions are installed or
+        removed: the modification times of the distribution metadata, like
+        ``*.dist-info`` directories, in the directories on :data:`sys.path`
+        and of the other entries on it, like zipped eggs.
         """
-        long_options = {}
-        for name, option in self.options.iteritems():
-            long_options[option.long] = (name, option)
-
-        if not self.allow_abbreviated_options:
-            return long_options
-        result = long_options.copy()
-        for abbr, long_option in abbreviations(long_options).iteritems():
-            result[abbr] = long_options[long_option]
-        return result
+        stamp = [self.group]
+        for path in sys.path:
+            path = path or os.curdir
+            try:
+                if not os.path.isdir(path):
+                    stamp.append((path, os.stat(path).st_mtime))
+                    continue
+                for name in sorted(os.listdir(path)):
+                    if name.endswith(_distribution_suffixes):
+                        stamp.append((path, name, os.stat(
+                            os.path.join(path, name)
+                        ).st_mtime))
+            except OSError:
+                pass
+        return stamp
 
     @property
-    def all_commands(self):
+    def entries(self):
         """
-        A dictionary mapping the command names (including abbreviations) to a
-        tuple of the complete command name and the command itself.
+        A list of the discovered :class:`PluginEntry` tuples.
         """
-        commands = dict((k, (k, v)) for k, v in self.commands.iteritems())
-        if not self.allow_abbreviated_commands:
-            return commands.copy()
-        for abbr, command in abbreviations(commands).iteritems():
-            commands[abbr] = commands[command]
-        return commands
+        if self._entries is None:
+            stamp = self.get_environment_stamp()
+            cached = self.read_cache_file()
+            entries = None
+            if cached is not None and cached[0] == stamp:
+                try:
+                    entries = [PluginEntry(*entry) for entry in cached[1]]
+                except TypeError:
+                    # written by another version
+                    pass
+            if entries is None:
+                entries = self.scan()
+                self.write_cache_file((stamp, map(tuple, entries)))
+            self._entries = entries
+        return self._entries
 
-    def apply_defaults(self, defaults):
-        for key, value in defaults.iteritems():
+    def scan(self):
+        """
+        Returns a list of :class:`PluginEntry` tuples for the entry points
+        in the group, without importing any command.
+        """
+        import pkg_resources
+        entries = []
+        for entry_point in pkg_resources.iter_entry_points(self.group):
+            entries.append(PluginEntry(
+                entry_point.name,
+                u"{0}:{1}".format(entry_point.module_name,
+                                  u".".join(entry_point.attrs))
+            ))
+        return entries
+
+    def read_cache_file(self):
+        try:
+            with open(self.cache_file, "rb") as f:
+                return marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def write_cache_file(self, content):
+        tmp_file = "{0}.{1}.tmp".format(self.cache_file, os.getpid())
+        try:
+            directory = os.path.dirname(self.cache_file)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_file, "wb") as f:
+                marshal.dump(content, f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            # the commands are discovered again next time
+            pass
+
+    def install(self, command):
+        """
+        Adds a :class:`LazyCommand` for every discovered command to the given
+        `command`, unless it has a command with the same name.
+        """
+        for entry in self.entries:
+            if entry.name not in command.commands:
+                command.commands[entry.name] = LazyCommand(entry.import_name)
+
+    def __repr__(self):
+        return "{0}({1!r}, cache_file={2!r})".format(
+            self.__class__.__name__, self.group, self.cache_file
+        )
+
+class Fallback(Exception):
+    """
+    Raised by compiled parsers if the arguments have to be evaluated by the
+    parser itself, e.g. to report an error.
+    """
+
+#: Maps the generated source of compiled parsers to code objects.
+_compiled_code = {}
+
+#: Attributes a command must not override to be compiled.
+_compiled_command_attributes = [
+    "evaluate", "evaluate_positionals", "evaluate_short_options",
+    "evaluate_long_option", "evaluate_option", "short_options",
+    "long_options", "all_commands", "telemetry", "constraints"
+]
+
+def _get_function(obj):
+    return getattr(obj, "im_func", obj)
+
+def _inherits(node, base, names):
+    """
+    Returns ``True`` if the given `node` uses the attributes with the given
+    `names` of the given `base` class.
+    """
+    cls = node.__class__
+    for name in names:
+        if name in node.__dict__ or _get_function(getattr(cls, name, None)) \
+                is not _get_function(getattr(base, name)):
+            return False
+    return True
+
+class ParserCompiler(object):
+    """
+    Generates the source of a module with a specialized function for every
+    command of the given `parser`, which have the dispatch on option and
+    command names, abbreviations included, and calls of converters built in.
+
+    Commands overriding any of the methods used for evaluation are evaluated
+    by calling their :meth:`Command.evaluate` method.
+    """
+    _inline_converters = {
+        _get_function(Option.evaluate): u"{0}",
+        _get_function(Positional.evaluate): u"{0}",
+        _get_function(IntNodeMixin.evaluate): u"int({0})",
+        _get_function(FloatNodeMixin.evaluate): u"float({0})",
+        _get_function(DecimalNodeMixin.evaluate): u"Decimal({0})"
+    }
+
+    _inline_accumulators = {
+        _get_function(AppendOption.accumulate):
+            u"options[{0}].append(value)",
+        _get_function(SetOption.accumulate): u"options[{0}].add(value)",
+        _get_function(CountOption.accumulate): u"options[{0}] += value"
+    }
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.namespace = {}
+        self.constant_names = {}
+        self.function_names = {}
+        self.functions = []
+        self.lines = []
+
+    def constant(self, obj):
+        """
+        Returns the name under which the given `obj` is available to the
+        generated code.
+        """
+        try:
+            return self.constant_names[id(obj)]
+        except KeyError:
+            name = "K{0}".format(len(self.constant_names))
+            self.constant_names[id(obj)] = name
+            self.namespace[name] = obj
+            return name
+
+    def write(self, indentation, line):
+        self.lines.append(u"    " * indentation + line)
+
+    def generate(self):
+        """
+        Returns a tuple of the generated source and a dictionary with the
+        objects the source refers to.
+        """
+        parser = self.parser
+        self.write(0, u"def evaluate(arguments):")
+        callpath = u"CallPath({0}, {1})".format(
+            self.constant(parser.script_name), self.constant(parser)
+        )
+        if _inherits(parser, Parser, _compiled_command_attributes):
+            self.write(1, u"return {0}({1}, arguments)".format(
+                self.add_command(parser, Parser), callpath
+            ))
+        else:
+            self.write(1, u"raise Fallback()")
+        self.functions.append(self.lines)
+        source = u"\n\n".join(u"\n".join(lines) for lines in self.functions)
+        return source + u"\n", self.namespace
+
+    def add_command(self, command, base=Command):
+        """
+        Generates the function evaluating the given `command`, if necessary,
+        and returns the name of it.
+        """
+        if not _inherits(command, base, _compiled_command_attributes):
+            return u"{0}.evaluate".format(self.constant(command))
+        try:
+            return self.function_names[id(command)]
+        except KeyError:
+            pass
+        name = u"evaluate_{0}".format(len(self.function_names))
+        self.function_names[id(command)] = name
+        self.constant(command)
+        lines, self.lines = self.lines, []
+        self.write_command(name, command)
+        self.functions.append(self.lines)
+        self.lines = lines
+        return name
+
+    def write_command(self, name, command):
+        write = self.write
+        options = sorted(command.options.items())
+        long_options = command.long_options
+        short_options = command.short_options
+        commands = sorted(command.commands.items())
+        all_commands = command.all_commands
+        indices = dict((id(option), i) for i, (_, option) in
+                       enumerate(options))
+        command_indices = dict((id(c), i) for i, (_, c) in
+                               enumerate(commands))
+
+        write(0, u"def {0}(callpath, arguments):".format(name))
+        write(1, u"options = {}")
+        for option_name, option in options:
+            default = command.defaults.get(option, option.default)
+            if option.accumulates:
+                write(1, u"options[{0!r}] = {1}.create_container({2})".format(
+                    option_name, self.constant(option), self.constant(default)
+                ))
+            elif default is not missing:
+                write(1, u"options[{0!r}] = {1}".format(
+                    option_name, self.constant(default)
+                ))
+        write(1, u"result = options, []")
+        write(1, u"tokens = tokenize(arguments)")
+        write(1, u"for kind, value, argument in tokens:")
+        write(2, u"if kind == LONG_OPTION:")
+        self.write_option_dispatch(
+            command, options, indices, long_options, u"value", 3, True
+        )
+        write(2, u"elif kind == SHORT_OPTIONS:")
+        write(3, u"for short in value:")
+        self.write_option_dispatch(
+            command, options, indices, short_options, u"short", 4, False
+        )
+        write(2, u"elif kind == TERMINATOR:")
+        write(3, u"result = options, list(tokens.rest())")
+        if not command.takes_arguments:
+            write(3, u"if result[1]:")
+            write(4, u"raise Fallback()")
+        write(3, u"break")
+        write(2, u"else:")
+        write(3, u"index = {0}.get(argument)".format(self.constant(dict(
+            (key, command_indices[id(c)])
+            for key, (_, c) in all_commands.iteritems()
+        ))))
+        write(3, u"if index is None:")
+        if command.takes_arguments:
+            write(4, u"result = options, [argument]")
+            write(4, u"result[1].extend(tokens.rest())")
+            write(4, u"break")
+        else:
+            write(4, u"raise Fallback()")
+        for i, (command_name, subcommand) in enumerate(commands):
+            write(3, u"{0} index == {1}:".format(u"if" if i == 0 else u"elif",
+                                                i))
+            write(4, u"result = {0}(callpath.extend(argument, {1}), "
+                     u"{2})".format(self.add_command(subcommand),
+                                    self.constant(subcommand),
+                                    u"tokens" if inherits_evaluate(subcommand)
+                                    else u"list(tokens.rest())"))
+            if command.callback is not None:
+                write(4, u"{0}.call_callback(result)".format(
+                    self.constant(command)
+                ))
+            write(4, u"return {{{0!r}: result}}, []".format(command_name))
+        if command.positionals:
+            self.write_positionals(command.positionals)
+        write(1, u"return result")
+
+    def write_option_dispatch(self, command, options, indices, table, key,
+                              indentation, is_long):
+        write = self.write
+        if not table:
+            write(indentation, u"raise Fallback()")
+            return
+        write(indentation, u"index = {0}.get({1})".format(
+            self.constant(dict((k, indices[id(option)])
+                               for k, (_, option) in table.iteritems())),
+            key
+        ))
+        write(indentation, u"if index is None:")
+        write(indentation + 1, u"raise Fallback()")
+        used = set(indices[id(option)] for _, option in table.itervalues())
+        first = True
+        for i, (name, option) in enumerate(options):
+            if i not in used:
+                continue
+            write(indentation, u"{0} index == {1}:".format(
+                u"if" if first else u"elif", i
+            ))
+            first = False
+            self.write_option(command, name, option, indentation + 1,
+                              is_long)
+
+    def write_option(self, command, name, option, indentation, is_long):
+        write = self.write
+        if option.requires_argument:
+            if is_long:
+                write(indentation, u"optional = tokens.pop_attached_value()")
+                write(indentation, u"if optional is missing:")
+                write(indentation + 1, u"optional = tokens.next_argument()")
+                argument = u"optional"
+            else:
+                argument = u"tokens.next_argument()"
+            write(indentation, u"value = {0}".format(
+                self.get_conversion(option, argument)
+            ))
+        elif option.allows_optional_argument:
+            if is_long:
+                write(indentation, u"optional = tokens.pop_attached_value()")
+            else:
+                write(indentation, u"optional = missing")
+            write(indentation, u"if optional is missing:")
+            write(indentation + 1, u"try:")
+            write(indentation + 2, u"optional = tokens.next_argument()")
+            write(indentation + 1, u"except StopIteration:")
+            write(indentation + 2, u"pass")
+            write(indentation, u"if optional is missing:")
+            write(indentation + 1, u"value = {0}".format(
+                self.get_evaluation(command, option)
+            ))
+            write(indentation, u"else:")
+            write(indentation + 1, u"value = {0}".format(
+                self.get_conversion(option, u"optional")
+            ))
+        else:
+            if is_long:
+                write(indentation, u"if tokens.attached is not None:")
+                write(indentation + 1, u"raise Fallback()")
+            write(indentation, u"value = {0}".format(
+                self.get_evaluation(command, option)
+            ))
+        if option.accumulates:
+            accumulator = _get_function(option.accumulate)
+            if "accumulate" not in option.__dict__ and \
+                    accumulator in self._inline_accumulators:
+                write(indentation, self._inline_accumulators[accumulator]
+                      .format(repr(name)))
+            else:
+                write(indentation,
+                      u"options[{0!r}] = {1}.accumulate(options[{0!r}], "
+                      u"value)".format(name, self.constant(option)))
+        else:
+            write(indentation, u"options[{0!r}] = value".format(name))
+
+    def get_evaluation(self, command, option):
+        """
+        Returns an expression evaluating the given `option` without an
+        argument.
+        """
+        if "evaluate" not in option.__dict__:
+            evaluate = _get_function(option.evaluate)
+            if evaluate is _get_function(BooleanOption.evaluate):
+                return repr(not command.defaults.get(option, option.default))
+            elif evaluate is _get_function(CountOption.evaluate):
+                return u"1"
+        return u"{0}.evaluate(callpath.extend(argument, {0}))".format(
+            self.constant(option)
+        )
+
+    def get_conversion(self, node, argument, label=u"argument"):
+        """
+        Returns an expression evaluating the given `argument` expression
+        with the given `node`, which appears on the callpath with the given
+        `label` expression.
+        """
+        callpath = u"callpath.extend({0}, {1})".format(label,
+                                                       self.constant(node))
+        if node.converter_cache is not None or "evaluate" in node.__dict__:
+            return u"evaluate_node({0}, {1}, {2})".format(
+                self.constant(node), callpath, argument
+            )
+        evaluate = _get_function(node.evaluate)
+        if evaluate in self._inline_converters:
+            return self._inline_converters[evaluate].format(argument)
+        return u"{0}.evaluate({1}, {2})".format(self.constant(node), callpath,
+                                                argument)
+
+    def write_positionals(self, positionals):
+        write = self.write
+        write(1, u"remaining = result[1]")
+        write(1, u"while True:")
+        for i, positional in enumerate(positionals):
+            if positional.takes_remaining:
+                write(2, u"remaining[{0}:] = [{1}.evaluate(callpath.extend("
+                         u"{2}, {1}), remaining[{0}:])]".format(
+                    i, self.constant(positional),
+                    self.constant(positional.metavar)
+                ))
+                break
+            write(2, u"if len(remaining) <= {0}:".format(i))
+            if positional.implicit_argument is missing:
+                write(3, u"break")
+                write(2, u"argument = remaining[{0}]".format(i))
+            else:
+                write(3, u"argument = {0}".format(
+                    self.constant(positional.implicit_argument)
+                ))
+                write(3, u"remaining.append(argument)")
+                write(2, u"else:")
+                write(3, u"argument = remaining[{0}]".format(i))
+            write(2, u"remaining[{0}] = {1}".format(i, self.get_conversion(
+                positional, u"argument", self.constant(positional.metavar)
+            )))
+        write(2, u"break")
+
+class CompiledParser(object):
+    """
+    A specialized version of the given `parser` whose :meth:`evaluate`
+    returns the same results as :meth:`Parser.evaluate`.
+
+    The parser is compiled as it is at the time of creation, so you have to
+    compile it again after changing it. Arguments which result in an error
+    are evaluated again by the parser itself, which reports the error.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+        #: The source generated by :class:`ParserCompiler`.
+        self.source, namespace = ParserCompiler(parser).generate()
+        try:
+            code = _compiled_code[self.source]
+        except KeyError:
+            code = _compiled_code[self.source] = compile(
+                self.source, "<compiled parser>", "exec"
+            )
+        namespace.update(Fallback=Fallback, Decimal=Decimal,
+                         evaluate_node=evaluate_node, tokenize=tokenize,
+                         CallPath=CallPath,
+                         missing=missing, LONG_OPTION=LONG_OPTION,
+                         SHORT_OPTIONS=SHORT_OPTIONS, TERMINATOR=TERMINATOR)
+        exec code in namespace
+        self._evaluate = namespace["evaluate"]
+        self._allow_response_files = parser.allow_response_files
+
+    def evaluate(self, arguments=None):
+        """
+        Evaluates the given list of ``arguments`` and returns a dictionary with
+        the options and a list with the remaining arguments.
+        """
+        if arguments is None:
+            arguments = sys.argv[1:]
+        arguments = decode_arguments(arguments)
+        expanded = arguments
+        if self._allow_response_files:
+            expanded = self.parser.expand_response_files(arguments)
+        try:
+            return self._evaluate(expanded)
+        except Fallback:
+            return self.parser.evaluate(arguments)
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.parser)
+
+class CommandPlan(object):
+    """
+    The evaluation of the given `command` for a certain list of arguments,
+    with every option and command looked up, created by
+    :func:`plan_command`.
+    """
+    def __init__(self, command):
+        self.command = command
+        #: A list of tuples of the argument, the name and the option itself
+        #: and the argument for the option or `missing`.
+        self.options = []
+        #: A tuple of the argument, the name and the command itself and a
+        #: plan or a list of arguments to evaluate it with, if any.
+        self.subcommand = None
+        #: The remaining arguments.
+        self.remaining = []
+
+    def execute(self, callpath):
+        """
+        Evaluates the options and positionals and returns the same result
+        as :meth:`Command.evaluate`.
+        """
+        command = self.command
+        options = command.create_options()
+        for argument, name, option, value in self.options:
+            option_callpath = callpath.extend(argument, option)
+            if value is missing:
+                value = option.evaluate(option_callpath)
+            else:
+                value = evaluate_node(option, option_callpath, value)
+            if option.accumulates:
+                options[name] = option.accumulate(options[name], value)
+            else:
+                options[name] = value
+        if self.subcommand is not None:
+            argument, name, subcommand, plan = self.subcommand
+            callpath = callpath.extend(argument, subcommand)
+            if isinstance(plan, CommandPlan):
+                result = plan.execute(callpath)
+            else:
+                result = subcommand.evaluate(callpath, plan)
+            if command.callback is not None:
+                command.call_callback(result)
+            return {name: result}, []
+        result = options, list(self.remaining)
+        if command.positionals:
+            command.evaluate_positionals(callpath, result[1])
+        return result
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.command)
+
+def plan_argument(option, tokens):
+    """
+    Returns the argument the given `option` takes from the given `tokens` or
+    `missing` if it does not take one.
+    """
+    argument = tokens.pop_attached_value()
+    if option.requires_argument or option.allows_optional_argument:
+        if argument is missing:
             try:
-                command = self.commands[key]
+                argument = tokens.next_argument()
+            except StopIteration:
+                if option.requires_argument:
+                    raise Fallback()
+    elif argument is not missing:
+        raise Fallback()
+    return argument
+
+def plan_command(command, tokens, base=Command):
+    """
+    Returns a :class:`CommandPlan` for evaluating the given `tokens` with the
+    given `command`.
+
+    Raises :exc:`Fallback` if the tokens cannot be evaluated without an error
+    or if the command overrides any of the methods used for evaluation.
+    """
+    if not _inherits(command, base, _compiled_command_attributes):
+        raise Fallback()
+    plan = CommandPlan(command)
+    for kind, value, argument in tokens:
+        if kind == LONG_OPTION:
+            try:
+                name, option = command.long_options[value]
             except KeyError:
-                self.options[key].default = value
-            else:
-                command.apply_defaults(value)
+                raise Fallback()
+            plan.options.append((argument, name, option,
+                                 plan_argument(option, tokens)))
+        elif kind == SHORT_OPTIONS:
+            short_options = command.short_options
+            for short in value:
+                try:
+                    name, option = short_options[short]
+                except KeyError:
+                    raise Fallback()
+                plan.options.append((argument, name, option,
+                                     plan_argument(option, tokens)))
+        elif kind == TERMINATOR:
+            plan.remaining = list(tokens.rest())
+            if plan.remaining and not command.takes_arguments:
+                raise Fallback()
+            break
+        else:
+            try:
+                name, subcommand = command.all_commands[argument]
+            except KeyError:
+                if not command.takes_arguments:
+                    raise Fallback()
+                plan.remaining = [argument]
+                plan.remaining.extend(tokens.rest())
+                break
+            try:
+                subplan = plan_command(subcommand, tokens)
+            except Fallback:
+                if _inherits(subcommand, Command,
+                             _compiled_command_attributes):
+                    raise
+                subplan = list(tokens.rest())
+            plan.subcommand = argument, name, subcommand, subplan
+            break
+    return plan
+
+class ArgumentCursor(object):
+    """
+    Iterates over the given list of `arguments` starting at the given
+    `position`, which is advanced with every argument taken.
+    """
+    def __init__(self, arguments, position=0):
+        self.arguments = arguments
+        self.position = position
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        try:
+            argument = self.arguments[self.position]
+        except IndexError:
+            raise StopIteration()
+        self.position += 1
+        return argument
+
+class IncrementalParser(object):
+    """
+    Evaluates arguments with the given `parser` like :meth:`Parser.evaluate`,
+    resuming from the state after the longest prefix the arguments share
+    with the previously evaluated ones.
 
-    def get_usage(self, callpath):
-        result = [u'usage: {0}'.format(u' '.join(map(itemgetter(0), callpath)))]
-        if self.options:
-            result.append(u'[options]')
-        if len(self.commands) > 1 or \
-                self.commands and u'help' not in self.commands:
-            result.append(u'[commands]')
-        for positional in self.positionals:
-            result.append(positional.metavar)
-        return u' '.join(result)
+    The state of the evaluation is recorded before every option or command,
+    so evaluating an edited list of arguments only evaluates the options
+    following the first changed argument again, the positionals and
+    callbacks are always evaluated. Like with :class:`ConverterCache`, the
+    evaluation of an option should not depend on anything but its argument.
+    Call :meth:`reset` after changing the parser.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+        self.reset()
 
-    def print_missing_node(self, node, callpath):
-        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
-        if node.startswith(u"-"):
-            write(callpath[-2][1].get_usage(callpath[:1]))
-            type = u"option"
-            possible_items = [option.long for option in self.options.values()]
-        else:
-            write(callpath[-1][1].get_usage(callpath[:1]))
-            type = u"command"
-            possible_items = self.commands.keys()
-        write(u'')
-        for shorter_version in shorter(node.strip(u'-')):
-            items = list(matches(shorter_version, possible_items))
-            if items:
+    def reset(self):
+        """
+        Forgets the previously evaluated arguments.
+        """
+        #: The previously evaluated arguments.
+        self.arguments = []
+        #: The number of arguments the previous evaluation resumed after.
+        self.resumed_at = 0
+        self._checkpoints = []
+
+    def evaluate(self, arguments=None):
+        """
+        Evaluates the given list of ``arguments`` and returns a dictionary with
+        the options and a list with the remaining arguments.
+        """
+        if arguments is None:
+            arguments = sys.argv[1:]
+        parser = self.parser
+        arguments = decode_arguments(arguments)
+        if parser.allow_response_files:
+            arguments = list(parser.expand_response_files(arguments))
+        if not _inherits(parser, Parser, _compiled_command_attributes):
+            self.reset()
+            return Command.evaluate(parser, CallPath(parser.script_name,
+                                                     parser), arguments)
+        unchanged = 0
+        for previous, argument in izip(self.arguments, arguments):
+            if previous != argument:
                 break
+            unchanged += 1
+        checkpoints = self._checkpoints
+        # An option taking an optional argument may have looked for it past
+        # the end of the previous arguments, so the state at the end is not
+        # valid if arguments have been appended.
+        if unchanged == len(self.arguments):
+            unchanged -= 1
+        while checkpoints and checkpoints[-1][0] > unchanged:
+            checkpoints.pop()
+        self.arguments = arguments
+        if checkpoints:
+            position, stack, command, callpath, options = checkpoints[-1]
+            options = self.copy_options(command, options)
         else:
-            items = list(matches(node.strip(u'-'), possible_items))
-        if not items:
-            write(u"The given {0} \"{1}\" does not exist.".format(type, node))
-            sys.exit(1)
-        write(u"The given {0} \"{1}\" does not exist, did you mean?" \
-                .format(type, node))
-        for item in items:
-            item = u'-' * node[:2].count(u'-') + item
-            write(u" - {0}".format(item))
-        write(u"")
-        sys.exit(1)
+            position, stack = 0, ()
+            command = parser
+            callpath = CallPath(parser.script_name, parser)
+            options = command.create_options()
+        self.resumed_at = position
+        return self.resume(ArgumentCursor(arguments, position), stack,
+                           command, callpath, options)
 
-    def evaluate(self, callpath, arguments):
+    def copy_options(self, command, options):
         """
-        Evaluates the given list of ``arguments`` and returns a dictionary with
-        the options and a list with remaining arguments.
+        Returns a copy of the given `options` of the `command` which does
+        not share the containers of accumulating options.
         """
-        options = {}
-        for name, option in self.options.iteritems():
-            if option.default is not missing:
-                options[name] = option.default
+        options = options.copy()
+        for name, option in command.options.iteritems():
+            if option.accumulates:
+                options[name] = copy.copy(options[name])
+        return options
+
+    def resume(self, cursor, stack, command, callpath, options):
+        """
+        Evaluates the arguments following the position of the given `cursor`
+        with the given state, like :meth:`Command.evaluate` does.
+        """
+        checkpoints = self._checkpoints
+        tokens = TokenStream(cursor)
         result = options, []
-        argument_iter = enumerate(arguments)
-        for i, argument in argument_iter:
-            if argument.startswith(u"--"):
-                callpath.append((argument, None))
-                options.update(self.evaluate_long_option(callpath,
-                                                         argument[2:],
-                                                         argument_iter))
-            elif argument.startswith(u"-"):
-                callpath.append((argument, None))
-                options.update(self.evaluate_short_options(callpath,
-                                                           list(argument[1:]),
-                                                           argument_iter))
+        while True:
+            if not checkpoints or checkpoints[-1][0] < cursor.position:
+                checkpoints.append((cursor.position, stack, command, callpath,
+                                    self.copy_options(command, options)))
+            try:
+                kind, value, argument = tokens.next()
+            except StopIteration:
+                break
+            if kind == LONG_OPTION:
+                command.evaluate_long_option(callpath.extend(argument, None),
+                                             value, tokens, options)
+            elif kind == SHORT_OPTIONS:
+                command.evaluate_short_options(
+                    callpath.extend(argument, None), value, tokens, options
+                )
+            elif kind == TERMINATOR:
+                result = options, list(tokens.rest())
+                if result[1] and not command.takes_arguments:
+                    command.print_missing_node(result[1][0], callpath)
+                    return
+                break
             else:
                 try:
-                    name, command = self.all_commands[arguments[i]]
+                    name, subcommand = command.all_commands[argument]
                 except KeyError:
-                    if not self.takes_arguments:
-                        self.print_missing_node(arguments[i], callpath)
+                    if not command.takes_arguments:
+                        command.print_missing_node(argument, callpath)
                         return
-                    result = options, arguments[i:]
+                    result = options, [argument]
+                    result[1].extend(tokens.rest())
                     break
-                callpath.append((arguments[i], command))
-                result = command.evaluate(callpath, arguments[1 + i:])
-                if self.callback is not None:
-                    self.callback(*result)
-                result = {name: result}, []
-                break
-        if self.positionals:
-            for i, (positional, arg) in enumerate(izip(self.positionals,
-                                                       result[1])):
-                callpath.append((positional.metavar, positional))
-                result[1][i] = positional.evaluate(callpath, arg)
-        return result
+                stack += ((command, name), )
+                callpath = callpath.extend(argument, subcommand)
+                if not _inherits(subcommand, Command,
+                                 _compiled_command_attributes):
+                    return self.unwind(
+                        stack, subcommand.evaluate(
+                            callpath, get_command_arguments(subcommand, tokens)
+                        )
+                    )
+                command = subcommand
+                options = command.create_options()
+                result = options, []
+        if command.positionals:
+            command.evaluate_positionals(callpath, result[1])
+        return self.unwind(stack, result)
 
-    def evaluate_short_options(self, callpath, shorts, arguments):
-        result = {}
-        for short in shorts:
-            try:
-                name, option = self.short_options[short]
-            except KeyError:
-                self.print_missing_node(u"-" + short, callpath)
-            callpath[-1] = (callpath[-1][0], option)
-            if option.requires_argument:
-                result[name] = option.evaluate(callpath, arguments.next()[1])
-            elif option.allows_optional_argument:
-                try:
-                    argument = arguments.next()[1]
-                except StopIteration:
-                    result[name] = option.evaluate(callpath)
-                else:
-                    result[name] = option.evaluate(callpath, argument)
-            else:
-                result[name] = option.evaluate(callpath)
+    def unwind(self, stack, result):
+        """
+        Calls the callbacks of the commands on the given `stack` and returns
+        the result of the outermost one.
+        """
+        for command, name in reversed(stack):
+            if command.callback is not None:
+                command.call_callback(result)
+            result = {name: result}, []
         return result
 
-    def evaluate_long_option(self, callpath, long, arguments):
-        try:
-            name, option = self.long_options[long]
-        except KeyError:
-            self.print_missing_node(callpath[-1][0], callpath)
-        callpath[-1] = (callpath[-1][0], option)
-        used_arguments = []
-        if option.requires_argument:
-            value = option.evaluate(callpath, arguments.next()[1])
-        elif option.allows_optional_argument:
-            try:
-                argument = arguments.next()[1]
-            except StopIteration:
-                value = option.evaluate(callpath)
-            else:
-                value = option.evaluate(callpath, argument)
-        else:
-            value = option.evaluate(callpath)
-        return {name: value}
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.parser)
 
-    def __getattr__(self, name):
-        for d in [self.commands, self.options]:
-            try:
-                return d[name]
-            except KeyError:
-                pass
-        raise AttributeError(name)
+#: The compiled parser used by a process evaluating records.
+_record_parser = None
 
-    def __repr__(self):
-        return ("{0}(options={1!r}, commands={2!r}, short_description={2!r}, "
-                "long_description={3!r}, callback={4!r})"). \
-                        format(self.__class__.__name__, self.options,
-                               self.commands, self.short_description,
-                               self.long_description, self.callback)
+def initialize_record_worker(snapshot):
+    global _record_parser
+    parser = pickle.loads(snapshot)
+    output = StringIO()
+    output.encoding = "utf-8"
+    parser.out_file = output
+    _record_parser = parser.compile(), output
 
-class HelpCommand(Command):
-    use_auto_help = False
+def evaluate_record(record):
+    """
+    Evaluates the given `record` in a process initialized by
+    :func:`initialize_record_worker` and returns a tuple of the arguments,
+    the result and the error message.
+    """
+    compiled, output = _record_parser
+    if isinstance(record, basestring):
+        record = split_line(record.strip())
+    arguments = decode_arguments(record)
+    try:
+        return arguments, compiled.evaluate(arguments), None
+    except SystemExit:
+        error = output.getvalue().decode("utf-8")
+    except Exception as exception:
+        error = u"{0}: {1}".format(exception.__class__.__name__, exception)
+    finally:
+        output.seek(0)
+        output.truncate()
+    return arguments, None, error
 
-    def __init__(self, options=None, commands=None,
-                 short_description=u"Shows this message.",
-                 long_description=u"Shows help messages.",
-                 callback=None,
-                 allow_abbreviated_commands=None,
-                 allow_abbreviated_options=None):
-        Command.__init__(self, options=options, commands=commands,
-                         short_description=short_description,
-                         long_description=long_description, callback=callback,
-                         allow_abbreviated_commands=allow_abbreviated_commands,
-                         allow_abbreviated_options=allow_abbreviated_options)
+class Column(object):
+    """
+    A column of values with a mask marking missing values.
 
-    def evaluate(self, callpath, arguments):
-        def get_node(node, argument, d):
+    Booleans, integers and floats are stored in an :class:`array.array`,
+    strings are dictionary-encoded, storing the index of each string in
+    :attr:`dictionary` in an array. A column containing values of any other
+    or of several types stores them in a list.
+
+    :param length:
+        The number of missing values the column starts with.
+    """
+    _typecodes = [(bool, "b"), ((int, long), "l"), (float, "d")]
+
+    def __init__(self, length=0):
+        #: The typecode of the array storing the values, ``"s"`` for strings
+        #: or ``"O"`` if the values are stored in a list.
+        self.typecode = None
+        #: The values, with ``0`` or ``None`` where the value is missing.
+        self.values = None
+        #: The strings of a dictionary-encoded column.
+        self.dictionary = None
+        self._codes = None
+        #: An array which is ``1`` where the value is missing.
+        self.mask = array("b", [1]) * length
+
+    def append(self, value):
+        """
+        Appends the given `value` or a missing value if it is `missing`.
+        """
+        if value is missing:
+            self.mask.append(1)
+            if self.typecode is not None:
+                self.values.append(None if self.typecode == "O" else 0)
+            return
+        if self.typecode is None:
+            self._initialize(value)
+        self.mask.append(0)
+        if self.typecode == "s":
+            if isinstance(value, basestring):
+                try:
+                    code = self._codes[value]
+                except KeyError:
+                    code = self._codes[value] = len(self.dictionary)
+                    self.dictionary.append(value)
+                self.values.append(code)
+                return
+        elif self.typecode == "O":
+            self.values.append(value)
+            return
+        elif type(value) in self._get_types(self.typecode):
             try:
-                node = d[node][1]
-            except KeyError:
-                command.print_missing_node(argument, callpath)
-            return node
+                self.values.append(value)
+                return
+            except OverflowError:
+                pass
+        self.mask.pop()
+        self._convert_to_list()
+        self.append(value)
 
-        command = callpath[-2][1]
-        try:
-            argument = arguments[0]
-        except IndexError:
-            argument, node = callpath[-2]
-            callpath = callpath[:-1]
+    def _get_types(self, typecode):
+        for types, code in self._typecodes:
+            if code == typecode:
+                return types if isinstance(types, tuple) else (types, )
+
+    def _initialize(self, value):
+        length = len(self.mask)
+        if isinstance(value, basestring):
+            self.typecode = "s"
+            self.dictionary = []
+            self._codes = {}
         else:
-            if argument.startswith(u'--'):
-                node = get_node(
-                    argument[2:],
-                    argument,
-                    command.long_options,
-                )
-                argument = argument[2:]
-            if argument.startswith(u'-'):
-                node = get_node(
-                    argument[1:],
-                    argument,
-                    command.short_options,
-                )
-                argument = argument[1:]
+            for types, typecode in self._typecodes:
+                if type(value) in self._get_types(typecode):
+                    self.typecode = typecode
+                    break
             else:
-                node = get_node(
-                    argument,
-                    argument,
-                    command.all_commands,
-                )
-            callpath = callpath[:-1] + [(argument, None)]
+                self.typecode = "O"
+                self.values = [None] * length
+                return
+        self.values = array("l" if self.typecode == "s" else self.typecode,
+                            [0]) * length
 
-        write = lambda x: callpath[0][1].out_file.write(x + u"\n")
-        write(node.get_usage(callpath))
-        write(u"")
-        write(node.long_description)
-        write(u"")
-        if not isinstance(node, Command):
-            sys.exit(1)
-        commands = sorted(node.commands.items(),
-                          key=lambda x: x[1]._position_hint)
-        options = sorted(node.options.values(),
-                         key=attrgetter("_position_hint"))
-        nodes = []
-        get_length = lambda nodes: max(10, max(len(n[0]) for n in nodes))
-        if commands:
-            nodes.append((u"Commands:", get_length(commands), commands))
-        if options:
-            option_nodes = []
-            for option in options:
-                if option.short is None:
-                    option_nodes.append(
-                        (u'--{0}'.format(option.long), option)
-                    )
-                elif option.long is None:
-                    option_nodes.append(
-                        (u'-{0}'.format(option.short), option)
-                    )
-                else:
-                    option_nodes.append((
-                        u'-{0} --{1}'.format(
-                            option.short, option.long
-                        ),
-                        option
-                    ))
-            nodes.append((u"Options:", get_length(option_nodes), option_nodes))
-        if getattr(node, 'positionals', False):
-            positional_nodes = [(p.metavar, p) for p in node.positionals]
-            nodes.append((
-                u"Positional arguments:",
-                get_length(positional_nodes),
-                positional_nodes
-            ))
-        for label, max_node_length, nodes in nodes:
-            write(label)
-            for node_name, node in nodes:
-                write(u" {0} {1}".format(node_name.ljust(max_node_length),
-                                         node.short_description))
-            write("")
-        sys.exit(1)
+    def _convert_to_list(self):
+        self.values = self.to_list()
+        self.typecode = "O"
+        self.dictionary = self._codes = None
 
-class Parser(Command):
-    def __init__(self, options=None, commands=None, positionals=None,
-                 script_name=None, description=None, out_file=sys.stdout,
-                 takes_arguments=None,defaults=None):
-        Command.__init__(self, options=options, commands=commands,
-                         positionals=positionals,
-                         long_description=description,
-                         takes_arguments=takes_arguments)
-        self.script_name = sys.argv[0] if script_name is None else script_name
-        self.out_file = out_file
-        if defaults is not None:
-            self.apply_defaults(defaults)
+    def to_list(self):
+        """
+        Returns a list of the values with ``None`` for missing values.
+        """
+        return list(self)
 
-    @property
-    def out_file(self):
+    def to_numpy(self):
         """
-        A file-like object to which any output is being written.
+        Returns a :class:`numpy.ma.MaskedArray` of the values, of the
+        dictionary codes in case of a column of strings. Requires NumPy.
         """
-        return self._out_file
+        import numpy
+        mask = numpy.array(self.mask, dtype=bool)
+        if self.typecode is None or self.typecode == "O":
+            values = numpy.array(self.to_list(), dtype=object)
+        else:
+            values = numpy.frombuffer(self.values, dtype=self.values.typecode)
+            if self.typecode == "b":
+                values = values.astype(bool)
+        return numpy.ma.MaskedArray(values, mask=mask)
 
-    @out_file.setter
-    def out_file(self, fobj):
-        if isinstance(fobj, codecs.StreamReaderWriter):
-            self._out_file = fobj
-        encoding = getattr(fobj, "encoding", None)
-        if encoding is None:
-            encoding = "ascii"
-            errors = "replace"
+    def __len__(self):
+        return len(self.mask)
+
+    def __getitem__(self, index):
+        if self.mask[index]:
+            return None
+        value = self.values[index]
+        if self.typecode == "s":
+            return self.dictionary[value]
+        elif self.typecode == "b":
+            return bool(value)
+        return value
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "{0}({1!r})".format(self.__class__.__name__, self.to_list())
+
+class ColumnarResults(object):
+    """
+    Stores the results of evaluating many argument lists with the given
+    `parser` in columns.
+
+    Every option gets a :class:`Column` named after the path to it, like
+    ``"build.jobs"`` for the option ``jobs`` of the command ``build``. The
+    remaining arguments of each row are stored in the :attr:`remaining`
+    column with the row starting at the corresponding offset in
+    :attr:`remaining_offsets`.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+        #: The number of rows.
+        self.length = 0
+        #: Maps the paths of options to columns.
+        self.columns = {}
+        #: The path of the command evaluated in each row, separated by
+        #: dots, the empty string if it is the parser itself.
+        self.commands = Column()
+        #: The remaining arguments of every row.
+        self.remaining = Column()
+        #: The offsets of the remaining arguments of each row in
+        #: :attr:`remaining`, followed by the number of remaining arguments.
+        self.remaining_offsets = array("l", [0])
+        #: The error of each row which could not be evaluated.
+        self.errors = Column()
+
+    def append(self, result, error=None):
+        """
+        Appends a row with the given `result` of :meth:`Parser.evaluate` or,
+        if the evaluation failed, with missing values and the given `error`.
+        """
+        values = {}
+        if result is None:
+            self.commands.append(missing)
+            remaining = []
         else:
-            errors = "strict"
-        codec_info = codecs.lookup(encoding)
-        self._out_file = codecs.StreamReaderWriter(fobj,
-                                                   codec_info.streamreader,
-                                                   codec_info.streamwriter,
-                                                   errors)
+            path, remaining = self._flatten(self.parser, result, u"", values)
+            self.commands.append(path)
+        for path, column in self.columns.iteritems():
+            column.append(values.pop(path, missing))
+        for path, value in values.iteritems():
+            column = self.columns[path] = Column(self.length)
+            column.append(value)
+        for argument in remaining:
+            self.remaining.append(argument)
+        self.remaining_offsets.append(len(self.remaining))
+        self.errors.append(missing if error is None else error)
+        self.length += 1
 
-    def evaluate(self, arguments=None):
+    def _flatten(self, command, result, prefix, values):
+        options, remaining = result
+        for name, value in options.iteritems():
+            if name in command.commands:
+                return self._flatten(command.commands[name], value,
+                                     prefix + name + u".", values)
+            values[prefix + name] = value
+        return prefix[:-1], remaining
+
+    def get_remaining(self, row):
         """
-        Evaluates the given list of ``arguments`` and returns a dictionary with
-        the options and a list with the remaining arguments.
+        Returns a list of the remaining arguments of the given `row`.
         """
-        if arguments is None:
-            arguments = sys.argv[1:]
-        arguments = decode_arguments(arguments)
-        return Command.evaluate(self, [(self.script_name, self)], arguments)
+        start, end = self.remaining_offsets[row:row + 2]
+        return [self.remaining[i] for i in xrange(start, end)]
+
+    def __getitem__(self, path):
+        return self.columns[path]
+
+    def __len__(self):
+        return self.length
 
     def __repr__(self):
-        return "{0}(script_name={1!r}, description={2!r})" \
-                .format(self.__class__.__name__, self.script_name,
-                        self.long_description)
+        return "<{0} {1} rows, {2} columns>".format(
+            self.__class__.__name__, self.length, len(self.columns)
+        )
@@ -9,14 +9,35 @@
     :copyright: 2010 by Daniel Neuhäuser
     :license: BSD, see LICENSE for details
 """
-import unittest
+import os
 import sys
+import json
+import pipes
+import pickle
+import shlex
+import random
+import shutil
+import time
+import tempfile
+import threading
+import subprocess
+import unittest
 from decimal import Decimal
 from StringIO import StringIO
 
 from opts import (Node, Option, BooleanOption, IntOption, FloatOption,
-                  DecimalOption, MultipleOptions, Positional, IntPositional,
-                  FloatPositional, DecimalPositional, Command, Parser)
+                  DecimalOption, MultipleOptions, AppendOption, SetOption,
+                  CountOption, Positional, IntPositional,
+                  FloatPositional, DecimalPositional, StreamPositional,
+                  Command, Parser, ConfigSource, ConverterCache,
+                  TokenStream, tokenize, Column, ColumnarResults, CallPath,
+                  IncrementalParser, Telemetry, FileSink, ChoiceProvider,
+                  DynamicChoiceOption, Choices, ChoiceOption,
+                  ChoicePositional, RangeSet, RangeSetOption, LazyFile,
+                  FileOption, FilePositional, PathPositional, GlobPositional,
+                  DocstringDescription, ResourceDescription, LazyCommand,
+                  PluginRegistry, Required, Exclusive, Requires, Conflicts)
+import opts
 
 def xrange(*args):
     if len(args) == 1:
@@ -52,6 +73,47 @@ class TestNode(TestCase):
         n = Node(short_description=u"Foobar")
         self.assertEqual(n.long_description, u"Foobar")
 
+    def test_deferred_description(self):
+        calls = []
+        def description():
+            calls.append(None)
+            return u'Deferred'
+        p = Parser(options={'a': Option('a', short_description=description)},
+                   out_file=StringIO())
+        p.evaluate([u'-a', u'b'])
+        self.assertEqual(calls, [])
+        self.assertRaises(SystemExit, p.evaluate, [u'help'])
+        self.assertTrue(u'Deferred' in p.out_file.getvalue())
+        self.assertEqual(p.a.long_description, u'Deferred')
+        self.assertEqual(calls, [None])
+
+    def test_docstring_description(self):
+        def build():
+            """
+            Builds everything.
+
+            Takes a while.
+            """
+        n = Node(short_description=DocstringDescription('opts:Node',
+                                                        summary=True),
+                 long_description=DocstringDescription(build))
+        self.assertEqual(n.short_description,
+                         u'Represents an argument passed to your script.')
+        self.assertEqual(n.long_description,
+                         u'Builds everything.\n\nTakes a while.')
+
+    def test_resource_description(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'descriptions.json')
+            with open(path, 'wb') as f:
+                json.dump({'build': u'Builds everything.'}, f)
+            n = Node(short_description=ResourceDescription(path, 'build'),
+                     long_description=ResourceDescription(path, 'missing'))
+            self.assertEqual(n.long_description, u'Builds everything.')
+        finally:
+            shutil.rmtree(directory)
+
 class TestOption(TestCase):
     def test_valueerror_on_init(self):
         self.assertRaises(ValueError, Option)
@@ -104,6 +166,310 @@ class TestMultipleOptions(TestCase):
             ({'o': [u'foo,bar', u'baz']}, [])
         )
 
+class TestAccumulatingOptions(TestCase):
+    def test_append_option(self):
+        p = Parser(options={
+            'include': AppendOption(IntOption, 'I', 'include'),
+            'verbose': BooleanOption('v')
+        })
+        self.assertEqual(
+            p.evaluate([]),
+            ({'include': [], 'verbose': False}, [])
+        )
+        self.assertEqual(
+            p.evaluate([u'-I', u'1', u'-vI', u'2', u'--include', u'3']),
+            ({'include': [1, 2, 3], 'verbose': True}, [])
+        )
+
+    def test_append_option_default(self):
+        default = [u'foo']
+        p = Parser(options={'include': AppendOption(short='I',
+                                                    default=default)})
+        self.assertEqual(
+            p.evaluate([u'-I', u'bar']),
+            ({'include': [u'foo', u'bar']}, [])
+        )
+        self.assertEqual(p.evaluate([]), ({'include': [u'foo']}, []))
+        self.assertEqual(default, [u'foo'])
+
+    def test_set_option(self):
+        p = Parser(options={'tag': SetOption(long='tag')})
+        self.assertEqual(
+            p.evaluate([u'--tag', u'a', u'--tag', u'b', u'--tag', u'a']),
+            ({'tag': set([u'a', u'b'])}, [])
+        )
+
+    def test_count_option(self):
+        p = Parser(options={'verbose': CountOption('v', 'verbose')})
+        self.assertEqual(p.evaluate([]), ({'verbose': 0}, []))
+        self.assertEqual(
+            p.evaluate([u'-vvv', u'--verbose']),
+            ({'verbose': 4}, [])
+        )
+
+class TestRangeSet(TestCase):
+    def test_parse(self):
+        ranges = RangeSet.parse(u'0-9999,20000-29999, 5,10:20,30000')
+        self.assertEqual(ranges.ranges, ((0, 10000), (20000, 30001)))
+        self.assertEqual(len(ranges), 20001)
+        self.assertEqual(unicode(ranges), u'0-9999,20000-30000')
+        self.assertEqual(unicode(RangeSet.parse(u'3,5-6')), u'3,5-6')
+        self.assertRaises(ValueError, RangeSet.parse, u'1-x')
+        self.assertRaises(ValueError, RangeSet.parse, u'9999-0')
+        self.assertRaises(ValueError, RangeSet.parse, u'5-4')
+        self.assertRaises(ValueError, RangeSet.parse, u'7:3')
+        self.assertEqual(RangeSet.parse(u'5-5,3:3').ranges, ((5, 6), ))
+
+    def test_membership(self):
+        ranges = RangeSet([(0, 3), (10, 12)])
+        for number in [0, 2, 10, 11]:
+            self.assertTrue(number in ranges)
+        for number in [-1, 3, 9, 12, 100]:
+            self.assertFalse(number in ranges)
+        self.assertEqual(list(ranges), [0, 1, 2, 10, 11])
+        self.assertFalse(RangeSet())
+
+    def test_huge(self):
+        ranges = RangeSet([(0, 10 ** 15)])
+        self.assertTrue(10 ** 15 - 1 in ranges)
+        self.assertEqual(len(ranges), 10 ** 15)
+
+    def test_option(self):
+        p = Parser(options={'shards': RangeSetOption('s', 'shards',
+                                                     default=u'100')})
+        self.assertEqual(
+            p.evaluate([u'-s', u'0-9', u'--shards', u'5:20,30']),
+            ({'shards': RangeSet([(0, 20), (30, 31), (100, 101)])}, [])
+        )
+        self.assertEqual(p.evaluate([]), ({'shards': RangeSet([(100, 101)])},
+                                          []))
+
+class TestConverterCache(TestCase):
+    def make_option(self, cache):
+        class CountingOption(Option):
+            evaluations = []
+
+            def evaluate(self, callpath, argument):
+                self.evaluations.append(argument)
+                return argument.upper()
+        CountingOption.converter_cache = cache
+        return CountingOption
+
+    def test_class_cache(self):
+        cache = ConverterCache()
+        option_class = self.make_option(cache)
+        p = Parser(options={
+            'host': option_class('h'),
+            'hosts': AppendOption(option_class, 'H')
+        })
+        for _ in range(3):
+            self.assertEqual(
+                p.evaluate([u'-h', u'a', u'-H', u'a', u'-H', u'b']),
+                ({'host': u'A', 'hosts': [u'A', u'B']}, [])
+            )
+        self.assertEqual(option_class.evaluations, [u'a', u'a', u'b'])
+        self.assertEqual((cache.hits, cache.misses), (6, 3))
+
+    def test_instance_cache(self):
+        option = self.make_option(None)('h')
+        option.converter_cache = ConverterCache()
+        p = Parser(options={'host': option}, positionals=[Positional('x')])
+        p.evaluate([u'-h', u'a'])
+        p.evaluate([u'-h', u'a'])
+        self.assertEqual(option.evaluations, [u'a'])
+        self.assertEqual(len(option.converter_cache), 1)
+
+    def test_maxsize(self):
+        cache = ConverterCache(maxsize=2)
+        option = self.make_option(cache)('h')
+        p = Parser(options={'host': option})
+        for argument in [u'a', u'b', u'a', u'c', u'b', u'a']:
+            p.evaluate([u'-h', argument])
+        self.assertEqual(option.evaluations, [u'a', u'b', u'c', u'b', u'a'])
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = ConverterCache(ttl=0)
+        option = self.make_option(cache)('h')
+        p = Parser(options={'host': option})
+        p.evaluate([u'-h', u'a'])
+        p.evaluate([u'-h', u'a'])
+        self.assertEqual(option.evaluations, [u'a', u'a'])
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+class TestChoices(TestCase):
+    def test_lookup(self):
+        choices = Choices([u'user', u'users', u'group', u'guest'])
+        self.assertEqual(choices.lookup(u'user'), u'user')
+        self.assertEqual(choices.lookup(u'users'), u'users')
+        self.assertEqual(choices.lookup(u'gr'), u'group')
+        self.assertEqual(choices.lookup(u'gue'), u'guest')
+        self.assertRaises(KeyError, choices.lookup, u'g')
+        self.assertRaises(KeyError, choices.lookup, u'use')
+        self.assertRaises(KeyError, choices.lookup, u'gr', False)
+        self.assertEqual(choices.prefixes, {u'gr': u'group', u'gro': u'group',
+                                            u'grou': u'group', u'gu': u'guest',
+                                            u'gue': u'guest',
+                                            u'gues': u'guest'})
+
+    def test_values(self):
+        class Color(object):
+            __members__ = {u'red': 1, u'green': 2}
+        self.assertEqual(Choices(Color).lookup(u're'), 1)
+        self.assertEqual(Choices({u'a': None}).lookup(u'a'), None)
+
+    def test_many(self):
+        names = [u'choice{0:04d}'.format(i) for i in range(5000)]
+        choices = Choices(names)
+        self.assertEqual(choices.lookup(u'choice4999'), u'choice4999')
+        self.assertEqual(len(choices.complete(u'choice49')), 100)
+        self.assertEqual(choices.get_suggestions(u'choice49x', 2),
+                         [u'choice4900', u'choice4901'])
+
+    def test_option(self):
+        p = Parser(
+            options={'color': ChoiceOption({u'red': 1, u'green': 2}, 'c')},
+            positionals=[ChoicePositional('mode', [u'fast', u'safe'])]
+        )
+        self.assertEqual(p.evaluate([u'-c', u'gr', u'sa']),
+                         ({'color': 2}, [u'safe']))
+        self.assertEqual(p.compile().evaluate([u'-c', u'red', u'f']),
+                         ({'color': 1}, [u'fast']))
+        try:
+            p.evaluate([u'-c', u'blue'])
+        except ValueError as error:
+            self.assertEqual(error.args[0], u'invalid choice: blue')
+        else:
+            self.fail('ValueError not raised')
+        self.assertRaises(ValueError, p.evaluate, [u'slow'])
+
+class TestDynamicChoiceOption(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def provider(self):
+        self.calls += 1
+        return [u'users', u'groups', u'user_groups']
+
+    def test_evaluate(self):
+        p = Parser(options={'table': DynamicChoiceOption(self.provider, 't')})
+        self.assertEqual(p.evaluate([u'-t', u'users']), ({'table': u'users'},
+                                                         []))
+        self.assertEqual(p.evaluate([u'-t', u'groups']),
+                         ({'table': u'groups'}, []))
+        self.assertEqual(self.calls, 1)
+        try:
+            p.evaluate([u'-t', u'usr'])
+        except ValueError as error:
+            self.assertEqual(
+                error.args[0],
+                u'invalid choice: usr, did you mean user_groups, users?'
+            )
+        else:
+            self.fail('ValueError not raised')
+        self.assertEqual(p.table.complete(u'gr'), [u'groups'])
+
+    def test_cache_file(self):
+        cache_file = os.path.join(self.directory, 'choices')
+        provider = ChoiceProvider(self.provider, cache_file=cache_file)
+        self.assertEqual(provider.get_choices().complete(u'u'),
+                         [u'user_groups', u'users'])
+        provider = ChoiceProvider(self.provider, cache_file=cache_file)
+        self.assertTrue(u'groups' in provider.get_choices())
+        self.assertEqual(self.calls, 1)
+
+    def test_cache_file_values(self):
+        cache_file = os.path.join(self.directory, 'choices')
+        provider = ChoiceProvider(lambda: {u'prod': 1, u'dev': 2},
+                                  cache_file=cache_file)
+        self.assertEqual(provider.get_choices().lookup(u'prod'), 1)
+        provider = ChoiceProvider(self.provider, cache_file=cache_file)
+        self.assertEqual(provider.get_choices().lookup(u'prod'), 1)
+        self.assertEqual(self.calls, 0)
+
+    def test_unwritable_cache_file(self):
+        cache_file = os.path.join(self.directory, 'missing', 'choices')
+        p = Parser(options={'table': DynamicChoiceOption(
+            ChoiceProvider(self.provider, cache_file=cache_file), 't'
+        )})
+        self.assertEqual(p.evaluate([u'-t', u'users']),
+                         ({'table': u'users'}, []))
+
+    def test_refresh_in_background(self):
+        provider = ChoiceProvider(self.provider, ttl=0)
+        provider.get_choices()
+        for _ in range(100):
+            if self.calls > 1:
+                break
+            time.sleep(0.01)
+        self.assertTrue(self.calls > 1)
+
+    def test_pickle(self):
+        option = DynamicChoiceOption(ChoiceProvider(list), 'c')
+        self.assertTrue(pickle.loads(pickle.dumps(option)).provider._lock)
+
+class TestFileOption(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input = os.path.join(self.directory, 'input')
+        with open(self.input, 'wb') as f:
+            f.write(b'spam\neggs\n')
+        self.output = os.path.join(self.directory, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_lazy(self):
+        p = Parser(options={'input': FileOption('i', buffering=4096)})
+        options, arguments = p.evaluate([u'-i', self.input])
+        lazy = options['input']
+        self.assertTrue(isinstance(lazy, LazyFile))
+        self.assertEqual(lazy.buffering, 4096)
+        self.assertFalse(lazy.opened)
+        with lazy:
+            self.assertEqual(list(lazy), [b'spam\n', b'eggs\n'])
+            self.assertTrue(lazy.opened)
+        self.assertFalse(lazy.opened)
+
+    def test_validation(self):
+        p = Parser(options={'input': FileOption('i')},
+                   positionals=[FilePositional('output', mode='wb')])
+        missing_file = os.path.join(self.directory, 'missing')
+        self.assertRaises(ValueError, p.evaluate, [u'-i', missing_file])
+        self.assertRaises(ValueError, p.evaluate, [u'-i', self.directory])
+        self.assertRaises(
+            ValueError, p.evaluate,
+            [os.path.join(self.directory, 'missing', 'output')]
+        )
+        options, arguments = p.evaluate([self.output])
+        self.assertFalse(os.path.exists(self.output))
+        self.assertEqual(p.evaluate([u'-i', u'-'])[0]['input'].file,
+                         sys.stdin)
+
+    def test_closed_after_callback(self):
+        files = []
+        def callback(options, arguments):
+            files.extend([options['input'], arguments[0]])
+            self.assertEqual(options['input'].mmap()[:4], b'spam')
+            arguments[0].write(b'foo')
+        p = Parser(commands={'run': Command(
+            commands={'copy': Command(
+                options={'input': FileOption('i')},
+                positionals=[FilePositional('output', mode='wb')]
+            )},
+            callback=callback
+        )})
+        for evaluate in [p.evaluate, p.compile().evaluate]:
+            del files[:]
+            evaluate([u'run', u'copy', u'-i', self.input, self.output])
+            self.assertEqual([f.opened for f in files], [False, False])
+            with open(self.output, 'rb') as f:
+                self.assertEqual(f.read(), b'foo')
+
 class TestPositional(TestCase):
     def test_evaluate(self):
         p = Parser(positionals=[Positional('foo')])
@@ -127,6 +493,239 @@ class TestNumberPositionals(TestCase):
         for i in range:
             self.assertEqual(parser.evaluate([unicode(i)]), ({}, [i]))
 
+class TestPathPositional(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.files = []
+        for i in range(100):
+            path = os.path.join(self.directory, str(i))
+            open(path, 'wb').close()
+            self.files.append(path.decode('utf-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_single(self):
+        p = Parser(positionals=[PathPositional('file', kind='file')])
+        self.assertEqual(p.evaluate([self.files[0]]), ({}, [self.files[0]]))
+        self.assertRaises(ValueError, p.evaluate, [self.directory])
+
+    def test_variadic(self):
+        p = Parser(positionals=[
+            PathPositional('directory', kind='directory'),
+            PathPositional('files', kind='file', access=os.R_OK,
+                           variadic=True)
+        ])
+        arguments = [self.directory] + self.files
+        expected = {}, [self.directory, self.files]
+        self.assertEqual(p.evaluate(arguments), expected)
+        self.assertEqual(p.compile().evaluate(arguments), expected)
+        self.assertEqual(p.evaluate([self.directory]),
+                         ({}, [self.directory, []]))
+
+    def test_errors(self):
+        p = Parser(positionals=[PathPositional('files', kind='file',
+                                               variadic=True)])
+        missing = [os.path.join(self.directory, u'missing{0}'.format(i))
+                   for i in range(2)]
+        arguments = missing[:1] + self.files + [self.directory] + missing[1:]
+        try:
+            p.evaluate(arguments)
+        except ValueError as error:
+            lines = error.args[0].splitlines()
+        else:
+            self.fail('ValueError not raised')
+        self.assertEqual(lines[0], u'3 invalid paths:')
+        self.assertEqual(lines[1:], [
+            u'{0}: No such file or directory'.format(missing[0]),
+            u'{0}: not a file'.format(self.directory),
+            u'{0}: No such file or directory'.format(missing[1])
+        ])
+
+class TestGlobPositional(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp().decode('utf-8')
+        for path in ['a.py', 'b.txt', '.hidden.py', 'sub/c.py',
+                     'sub/deep/e.py', '.git/f.py']:
+            path = os.path.join(self.directory, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'wb').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def glob(self, pattern, **kwargs):
+        p = Parser(positionals=[GlobPositional('pattern', **kwargs)])
+        matches = p.evaluate([os.path.join(self.directory, pattern)])[1][0]
+        self.assertFalse(isinstance(matches, list))
+        return sorted(os.path.relpath(path, self.directory)
+                      for path in matches)
+
+    def test_glob(self):
+        self.assertEqual(self.glob(u'*.py'), [u'a.py'])
+        self.assertEqual(self.glob(u'.*.py'), [u'.hidden.py'])
+        self.assertEqual(self.glob(u'*/c.py'), [u'sub/c.py'])
+        self.assertEqual(self.glob(u'b.txt'), [u'b.txt'])
+        self.assertEqual(self.glob(u'missing'), [])
+        self.assertEqual(self.glob(u'[ab].*'), [u'a.py', u'b.txt'])
+
+    def test_recursive(self):
+        self.assertEqual(self.glob(u'**/*.py'),
+                         [u'a.py', u'sub/c.py', u'sub/deep/e.py'])
+        self.assertEqual(self.glob(u'sub/**'),
+                         [u'sub', u'sub/c.py', u'sub/deep', u'sub/deep/e.py'])
+        self.assertEqual(self.glob(u'**/*.py', recursive=False),
+                         [u'sub/c.py'])
+
+    def test_relative(self):
+        old_directory = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            p = Parser(positionals=[GlobPositional('pattern')])
+            for pattern, expected in [
+                    (u'**/*.py', [u'a.py', u'sub/c.py', u'sub/deep/e.py']),
+                    (u'**', [u'a.py', u'b.txt', u'sub', u'sub/c.py',
+                             u'sub/deep', u'sub/deep/e.py']),
+                    (u'sub/**', [u'sub/', u'sub/c.py', u'sub/deep',
+                                 u'sub/deep/e.py'])]:
+                self.assertEqual(sorted(p.evaluate([pattern])[1][0]),
+                                 expected)
+        finally:
+            os.chdir(old_directory)
+
+    def test_variadic(self):
+        p = Parser(positionals=[GlobPositional('patterns', variadic=True)])
+        matches = p.evaluate([os.path.join(self.directory, pattern)
+                              for pattern in [u'*.txt', u'sub/*.py']])[1][0]
+        self.assertEqual(
+            [os.path.relpath(path, self.directory) for path in matches],
+            [u'b.txt', u'sub/c.py']
+        )
+
+class TestStreamPositional(TestCase):
+    def test_stdin(self):
+        stream = StringIO('1\n2\n\n3')
+        p = Parser(positionals=[
+            StreamPositional('n', IntPositional, stream=stream)
+        ])
+        options, arguments = p.evaluate([u'-'])
+        self.assertEqual(options, {})
+        self.assertEqual(stream.tell(), 0)
+        self.assertEqual(list(arguments[0]), [1, 2, 3])
+
+    def test_nul_separated(self):
+        stream = StringIO('foo\nbar\0baz')
+        p = Parser(positionals=[
+            StreamPositional('path', separator=b'\0', stream=stream)
+        ])
+        self.assertEqual(
+            list(p.evaluate([u'-'])[1][0]),
+            [u'foo\nbar', u'baz']
+        )
+
+    def test_argument(self):
+        stream = StringIO('1\n2')
+        p = Parser(positionals=[
+            StreamPositional('n', IntPositional, stream=stream)
+        ])
+        self.assertEqual(list(p.evaluate([u'3'])[1][0]), [3])
+
+    def test_use_stdin(self):
+        stream = StringIO('1\n2')
+        p = Parser(positionals=[
+            StreamPositional('n', IntPositional, use_stdin=True, stream=stream)
+        ])
+        self.assertEqual(list(p.evaluate([])[1][0]), [1, 2])
+
+    def test_callback(self):
+        stream = StringIO('foo\nbar')
+        results = []
+        def callback(options, arguments):
+            results.extend(arguments[0])
+        p = Parser(commands={'a': Command(
+            commands={'b': Command(
+                positionals=[StreamPositional('path', stream=stream)]
+            )},
+            callback=callback
+        )})
+        p.evaluate([u'a', u'b', u'-'])
+        self.assertEqual(results, [u'foo', u'bar'])
+
+class TestTokenStream(TestCase):
+    def test_kinds(self):
+        self.assertEqual(
+            [tuple(token) for token in tokenize([
+                u'--foo', u'--bar=baz', u'-abc', u'-', u'spam', u'--', u'-a'
+            ])],
+            [
+                ('long option', u'foo', u'--foo'),
+                ('long option', u'bar', u'--bar=baz'),
+                ('attached value', u'baz', u'--bar=baz'),
+                ('short options', u'abc', u'-abc'),
+                ('word', u'-', u'-'),
+                ('word', u'spam', u'spam'),
+                ('terminator', u'--', u'--'),
+                ('short options', u'a', u'-a')
+            ]
+        )
+
+    def test_next_argument(self):
+        tokens = tokenize([u'--foo=bar', u'--baz', u'spam'])
+        self.assertEqual(tokens.next().value, u'foo')
+        self.assertEqual(tokens.next_argument(), u'bar')
+        self.assertEqual(tokens.next_argument(), u'--baz')
+        self.assertEqual(tokens.next().kind, 'word')
+        self.assertRaises(StopIteration, tokens.next_argument)
+
+    def test_rest(self):
+        tokens = tokenize(iter([u'--', u'-a', u'--b']))
+        self.assertEqual(tokens.next().kind, 'terminator')
+        self.assertEqual(list(tokens.rest()), [u'-a', u'--b'])
+
+    def test_tokenize_stream(self):
+        tokens = TokenStream([])
+        self.assertTrue(tokenize(tokens) is tokens)
+
+class TestCallPath(TestCase):
+    def test_extend(self):
+        root = CallPath(u'script', None)
+        a = root.extend(u'-a', 1)
+        b = root.extend(u'-b', 2)
+        self.assertTrue(a.parent is root and b.parent is root)
+        self.assertEqual(len(root), 1)
+        self.assertEqual(len(a), 2)
+        self.assertEqual(a, [(u'script', None), (u'-a', 1)])
+        self.assertEqual(b.replace(3), [(u'script', None), (u'-b', 3)])
+        self.assertEqual(a + [(u'c', 4)],
+                         [(u'script', None), (u'-a', 1), (u'c', 4)])
+
+    def test_sequence(self):
+        path = CallPath.from_list([(u'a', 1), (u'b', 2), (u'c', 3)])
+        self.assertEqual(list(path), [(u'a', 1), (u'b', 2), (u'c', 3)])
+        self.assertEqual(list(reversed(path)), [(u'c', 3), (u'b', 2),
+                                                (u'a', 1)])
+        self.assertEqual(path[0], (u'a', 1))
+        self.assertEqual(path[-2], (u'b', 2))
+        self.assertEqual(path[:-1], [(u'a', 1), (u'b', 2)])
+        self.assertRaises(IndexError, lambda: path[3])
+        self.assertTrue(CallPath.from_list(path) is path)
+
+    def test_evaluation(self):
+        callpaths = []
+        class RecordingOption(Option):
+            def evaluate(self, callpath, argument):
+                callpaths.append(callpath.to_list())
+                return argument
+        option = RecordingOption('a')
+        command = Command(options={'a': option})
+        p = Parser(options={'b': RecordingOption('b')},
+                   commands={'c': command})
+        p.evaluate([u'-b', u'x', u'c', u'-a', u'y', u'-a', u'z'])
+        self.assertEqual(callpaths[1:], [
+            [(p.script_name, p), (u'c', command), (u'-a', option)]
+        ] * 2)
+
 class TestCommand(TestCase):
     def test_remaining_arguments(self):
         c = Command(options={'a': Option('a')})
@@ -252,9 +851,68 @@ class TestCommand(TestCase):
                 'eggs': 'blubb'
             }
         })
-        self.assertEquals(p.options['activate'].default, 'huhu')
-        self.assertEquals(p.commands['foo'].options['spam'].default, 'bla')
-        self.assertEquals(p.commands['foo'].options['eggs'].default, 'blubb')
+        self.assertEquals(p.get_default('activate'), 'huhu')
+        self.assertEquals(p.commands['foo'].get_default('spam'), 'bla')
+        self.assertEquals(p.commands['foo'].get_default('eggs'), 'blubb')
+        self.assertEquals(p.options['activate'].default, False)
+
+    def test_shared_options(self):
+        verbose = BooleanOption('v')
+        jobs = IntOption('j', default=1)
+        p = Parser(
+            options={'verbose': verbose},
+            commands={
+                'build': Command(options={'verbose': verbose, 'jobs': jobs}),
+                'test': Command(options={'verbose': verbose, 'jobs': jobs})
+            },
+            defaults={'build': {'verbose': True, 'jobs': 4}}
+        )
+        self.assertEqual(
+            p.evaluate([u'-v']),
+            ({'verbose': True}, [])
+        )
+        self.assertEqual(
+            p.evaluate([u'build', u'-v']),
+            ({'build': ({'verbose': False, 'jobs': 4}, [])}, [])
+        )
+        self.assertEqual(
+            p.evaluate([u'test', u'-v']),
+            ({'test': ({'verbose': True, 'jobs': 1}, [])}, [])
+        )
+        self.assertEqual((verbose.default, jobs.default), (False, 1))
+
+    def test_shared_help_command(self):
+        p = Parser(commands={'foo': Command(), 'bar': Command()})
+        self.assertTrue(p.commands['help'] is p.foo.commands['help'])
+        self.assertTrue(p.commands['help'] is p.bar.commands['help'])
+
+    def test_terminator(self):
+        p = Parser(
+            options={'a': BooleanOption('a')},
+            commands={'foo': Command()}
+        )
+        self.assertEqual(
+            p.evaluate([u'-a', u'--', u'-a', u'foo', u'--']),
+            ({'a': True}, [u'-a', u'foo', u'--'])
+        )
+        self.assertEqual(
+            p.evaluate([u'foo', u'--', u'-a']),
+            ({'foo': ({}, [u'-a'])}, [])
+        )
+
+    def test_attached_value(self):
+        p = Parser(options={
+            'foo': Option(long='foo'),
+            'bar': IntOption(long='bar')
+        })
+        self.assertEqual(
+            p.evaluate([u'--foo=spam=eggs', u'--bar=1', u'--fo=']),
+            ({'foo': u'', 'bar': 1}, [])
+        )
+        self.assertEqual(
+            p.evaluate([u'--foo', u'--bar=1']),
+            ({'foo': u'--bar=1'}, [])
+        )
 
     def test_getattr(self):
         p = Parser(
@@ -288,6 +946,135 @@ class TestCommand(TestCase):
             ({'foo': ({'a': True}, [])}, [])
         )
 
+class TestPluginRegistry(TestCase):
+    group = 'opts.tests.commands'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'opts_test_plugin.py'),
+                  'wb') as f:
+            f.write(
+                'from opts import Command, Option\n'
+                'greet = Command(options={"name": Option("n")},\n'
+                '                short_description=u"Greets someone.")\n'
+            )
+        sys.path.insert(0, self.directory)
+        import pkg_resources
+        distribution = pkg_resources.Distribution(
+            location=self.directory, project_name='opts-test-plugin',
+            version='1.0'
+        )
+        distribution._ep_map = {self.group: {
+            'greet': pkg_resources.EntryPoint.parse(
+                'greet = opts_test_plugin:greet', dist=distribution
+            )
+        }}
+        pkg_resources.working_set.add(distribution)
+
+    def tearDown(self):
+        sys.path.remove(self.directory)
+        sys.modules.pop('opts_test_plugin', None)
+        shutil.rmtree(self.directory)
+
+    def test_discovery(self):
+        cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_directory)
+        cache_file = os.path.join(cache_directory, 'plugins')
+        registry = PluginRegistry(self.group, cache_file=cache_file)
+        self.assertEqual(registry.entries, [opts.PluginEntry(
+            'greet', u'opts_test_plugin:greet'
+        )])
+        self.assertFalse('opts_test_plugin' in sys.modules)
+
+        p = Parser(out_file=StringIO())
+        PluginRegistry(self.group, cache_file=cache_file).install(p)
+        self.assertTrue(isinstance(p.commands['greet'], LazyCommand))
+        self.assertEqual(p.evaluate([u'x']), ({}, [u'x']))
+        self.assertFalse('opts_test_plugin' in sys.modules)
+        self.assertEqual(p.evaluate([u'greet', u'-n', u'World']),
+                         ({'greet': ({'name': u'World'}, [])}, []))
+        self.assertTrue('opts_test_plugin' in sys.modules)
+
+    def test_descriptions(self):
+        p = Parser(commands={
+            'greet': LazyCommand('opts_test_plugin:greet',
+                                 short_description=u'Says hello.')
+        }, out_file=StringIO())
+        self.assertRaises(SystemExit, p.evaluate, [u'help'])
+        self.assertTrue(u'Says hello.' in p.out_file.getvalue())
+        self.assertFalse('opts_test_plugin' in sys.modules)
+
+        p = self.make_parser()
+        self.assertRaises(SystemExit, p.evaluate, [u'help'])
+        self.assertTrue(u'Greets someone.' in p.out_file.getvalue())
+
+    def test_lazy_command(self):
+        p = Parser(commands={'greet': LazyCommand('opts_test_plugin:greet')})
+        self.assertEqual(
+            p.compile().evaluate([u'greet', u'-n', u'World', u'x']),
+            ({'greet': ({'name': u'World'}, [u'x'])}, [])
+        )
+        self.assertEqual(p.greet.name, u'opts_test_plugin:greet')
+        self.assertTrue(p.greet.command is sys.modules['opts_test_plugin']
+                        .greet)
+
+    def test_default_cache_file(self):
+        cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_directory)
+        old_cache_home = os.environ.get('XDG_CACHE_HOME')
+        def restore_cache_home():
+            if old_cache_home is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = old_cache_home
+        self.addCleanup(restore_cache_home)
+        os.environ['XDG_CACHE_HOME'] = cache_directory
+        PluginRegistry(self.group).entries
+        self.assertTrue(os.path.exists(os.path.join(
+            cache_directory, 'opts', 'plugins-' + self.group
+        )))
+        self.assertEqual(self.cached_entries(PluginRegistry(self.group)),
+                         [opts.PluginEntry('greet',
+                                           u'opts_test_plugin:greet')])
+
+    def test_cache_file_on_path(self):
+        cache_file = os.path.join(self.directory, 'plugins')
+        PluginRegistry(self.group, cache_file=cache_file).entries
+        open(os.path.join(self.directory, 'log'), 'wb').close()
+        self.assertEqual(
+            len(self.cached_entries(PluginRegistry(self.group,
+                                                   cache_file=cache_file))),
+            1
+        )
+        os.mkdir(os.path.join(self.directory, 'other-1.0.dist-info'))
+        registry = PluginRegistry(self.group, cache_file=cache_file)
+        self.assertRaises(AssertionError, self.cached_entries, registry)
+
+    def cached_entries(self, registry):
+        def scan():
+            raise AssertionError('cache not used')
+        registry.scan = scan
+        return registry.entries
+
+    def test_unloaded_commands(self):
+        p = self.make_parser()
+        batches = []
+        telemetry = Telemetry(batches.append, flush_interval=3600)
+        telemetry.install(p)
+        p.snapshot()
+        self.assertFalse('opts_test_plugin' in sys.modules)
+        self.assertTrue(p.greet.telemetry is telemetry)
+        p.evaluate([u'greet', u'-n', u'World'])
+        self.assertTrue(p.greet.command.telemetry is telemetry)
+        telemetry.flush()
+        self.assertEqual(batches[0][opts.OPTION], {u'greet.name': 1})
+
+    def make_parser(self):
+        return Parser(
+            commands={'greet': LazyCommand('opts_test_plugin:greet')},
+            out_file=StringIO()
+        )
+
 class TestParser(TestCase):
     def test_default_evaluate_arguments(self):
         old_argv = sys.argv
@@ -297,6 +1084,158 @@ class TestParser(TestCase):
         self.assertEqual(p.evaluate(), ({}, [u'foo', u'bar']))
         sys.argv = old_argv
 
+class TestConfigSource(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        opts._config_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        opts._config_cache.clear()
+
+    def write(self, name, content, mtime=1000):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def make_parser(self, config):
+        return Parser(
+            options={
+                'verbose': BooleanOption('v'),
+                'jobs': IntOption('j', default=1)
+            },
+            commands={
+                'build': Command(options={'target': Option('t')})
+            },
+            config=config
+        )
+
+    def test_accumulating_options(self):
+        path = self.write('config.ini', '\n'.join([
+            '[opts]',
+            'include = foo',
+            'jobs = 1, 2,3',
+            'verbose = 3'
+        ]))
+        p = Parser(
+            options={
+                'include': AppendOption(short='I'),
+                'jobs': SetOption(IntOption, 'j'),
+                'verbose': CountOption('v')
+            },
+            config=ConfigSource([path])
+        )
+        self.assertEqual(p.evaluate([]), ({
+            'include': [u'foo'], 'jobs': set([1, 2, 3]), 'verbose': 3
+        }, []))
+        options = p.evaluate([u'-I', u'bar', u'-v'])[0]
+        self.assertEqual(options['include'], [u'foo', u'bar'])
+        self.assertEqual(options['verbose'], 4)
+
+    def test_hierarchy(self):
+        system = self.write('system.json', json.dumps({
+            'jobs': 2,
+            'build': {'target': 'all'}
+        }))
+        user = self.write('user.ini', '\n'.join([
+            '[opts]',
+            'jobs = 4',
+            'verbose = yes',
+            '[other]',
+            'jobs = 8'
+        ]))
+        project = self.write('project.ini', '\n'.join([
+            '[opts.build]',
+            'target = docs'
+        ]))
+        missing = os.path.join(self.directory, 'missing.ini')
+        p = self.make_parser(ConfigSource([system, user, missing, project]))
+        self.assertEqual(p.evaluate([]), ({'verbose': True, 'jobs': 4}, []))
+        self.assertEqual(
+            p.evaluate([u'build']),
+            ({'build': ({'target': u'docs'}, [])}, [])
+        )
+
+    def test_memory_cache(self):
+        path = self.write('config.json', json.dumps({'jobs': 2}))
+        source = ConfigSource([path])
+        self.assertEqual(source.load(), [(path, {'jobs': 2})])
+        content = source.load()[0][1]
+        self.assertTrue(source.load()[0][1] is content)
+        self.write('config.json', json.dumps({'jobs': 3}), mtime=2000)
+        self.assertEqual(source.load(), [(path, {'jobs': 3})])
+
+    def test_cache_file(self):
+        path = self.write('config.json', json.dumps({'jobs': 2}))
+        cache_file = os.path.join(self.directory, 'cache')
+        ConfigSource([path], cache_file=cache_file).load()
+        self.assertTrue(os.path.exists(cache_file))
+        opts._config_cache.clear()
+        old_parse_config_file = opts.parse_config_file
+        def parse_config_file(path, section):
+            raise AssertionError('cache not used for {0}'.format(path))
+        opts.parse_config_file = parse_config_file
+        try:
+            p = self.make_parser(ConfigSource([path], cache_file=cache_file))
+        finally:
+            opts.parse_config_file = old_parse_config_file
+        self.assertEqual(p.evaluate([]), ({'verbose': False, 'jobs': 2}, []))
+
+    def test_unwritable_cache_file(self):
+        path = self.write('config.json', json.dumps({'jobs': 2}))
+        cache_file = os.path.join(self.directory, 'missing', 'cache')
+        p = self.make_parser(ConfigSource([path], cache_file=cache_file))
+        self.assertEqual(p.evaluate([]), ({'verbose': False, 'jobs': 2}, []))
+
+class TestResponseFiles(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_newline_separated(self):
+        path = self.write('args', '-a\nspam\r\n\nfoo\nbar baz\n')
+        p = Parser(options={'a': Option('a')}, allow_response_files=True)
+        self.assertEqual(
+            p.evaluate([u'@' + path, u'eggs']),
+            ({'a': u'spam'}, [u'foo', u'bar baz', u'eggs'])
+        )
+
+    def test_nul_separated(self):
+        path = self.write('args', 'foo\nbar\0baz\0')
+        p = Parser(allow_response_files=True)
+        self.assertEqual(
+            p.evaluate([u'@' + path]),
+            ({}, [u'foo\nbar', u'baz'])
+        )
+
+    def test_chunked(self):
+        arguments = [unicode(i) for i in range(1000)]
+        path = self.write('args', '\n'.join(arguments))
+        p = Parser(allow_response_files=True)
+        p.response_file_chunk_size = 7
+        self.assertEqual(p.evaluate([u'@' + path]), ({}, arguments))
+
+    def test_lazy(self):
+        path = self.write('args', 'foo\nbar\n')
+        p = Parser(allow_response_files=True)
+        expanded = p.expand_response_files([u'@' + path])
+        self.assertEqual(expanded.next(), u'foo')
+        self.assertEqual(list(expanded), [u'bar'])
+
+    def test_disabled(self):
+        p = Parser()
+        self.assertEqual(p.evaluate([u'@foo']), ({}, [u'@foo']))
+
 class OutputTest(TestCase):
     def setUp(self):
         self.out_file = StringIO()
@@ -307,6 +1246,93 @@ class OutputTest(TestCase):
         self.out_file = StringIO()
         sys.argv = self._old_argv
 
+class TestTelemetry(TestCase):
+    def make_parser(self):
+        return Parser(
+            options={'verbose': CountOption('v', 'verbose')},
+            commands={'build': Command(
+                options={'jobs': IntOption('j', 'jobs')}
+            )},
+            out_file=StringIO()
+        )
+
+    def test_counts(self):
+        batches = []
+        p = self.make_parser()
+        telemetry = Telemetry(batches.append, flush_interval=3600)
+        telemetry.install(p)
+        p.evaluate([u'-vv', u'--verbose', u'build', u'--jobs=2', u'-j', u'3'])
+        p.compile().evaluate([u'build', u'-j', u'1'])
+        self.assertRaises(SystemExit, p.evaluate, [u'--unknown'])
+        self.assertRaises(ValueError, p.evaluate, [u'build', u'-j', u'x'])
+        telemetry.flush()
+        self.assertEqual(batches, [{
+            opts.COMMAND: {u'build': 3},
+            opts.OPTION: {u'verbose': 3, u'build.jobs': 4, u'--unknown': 1},
+            opts.ERROR: {u'unknown option': 1, u'ValueError': 1}
+        }])
+        telemetry.flush()
+        self.assertEqual(len(batches), 1)
+
+    def test_sampling(self):
+        batches = []
+        p = self.make_parser()
+        telemetry = Telemetry(batches.append, sample_every=3,
+                              flush_interval=3600)
+        telemetry.install(p)
+        for _ in range(9):
+            p.evaluate([u'-v'])
+        telemetry.flush()
+        self.assertEqual(batches[0][opts.OPTION], {u'verbose': 3})
+
+    def test_file_sink(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'telemetry.json')
+            sink = FileSink(path)
+            sink({opts.COMMAND: {u'build': 1}})
+            sink({opts.COMMAND: {u'build': 2}})
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+            self.assertEqual([line[u'commands'] for line in lines],
+                             [{u'build': 1}, {u'build': 2}])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_flush_at_exit(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'telemetry.json')
+            script = '\n'.join([
+                'import sys',
+                'sys.path.insert(0, {0!r})',
+                'from opts import Parser, CountOption, Telemetry, FileSink',
+                'p = Parser(options={{"verbose": CountOption("v")}})',
+                'Telemetry(FileSink({1!r})).install(p)',
+                'p.evaluate([u"-v"])'
+            ]).format(os.path.dirname(os.path.abspath(opts.__file__)), path)
+            self.assertEqual(subprocess.call([sys.executable, '-c', script]),
+                             0)
+            with open(path) as file:
+                lines = [json.loads(line) for line in file]
+            self.assertEqual([line[u'options'] for line in lines],
+                             [{u'verbose': 1}])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_snapshot(self):
+        p = self.make_parser()
+        Telemetry(lambda batch: None).install(p)
+        self.assertTrue(p.snapshot().build.telemetry is None)
+
+    def test_other_parsers_unaffected(self):
+        p = self.make_parser()
+        Telemetry(lambda batch: None).install(p)
+        other = Parser()
+        self.assertTrue(other.help.telemetry is None)
+        self.assertEqual(pickle.loads(pickle.dumps(other)).evaluate([]),
+                         ({}, []))
+
 class TestParserOutput(OutputTest):
     def test_alternative_commands(self):
         p = Parser(
@@ -364,6 +1390,26 @@ class TestParserOutput(OutputTest):
         self.assertContains(output, u'usage: script')
         self.assertContains(output, u'option "--foo" does not exist')
 
+    def test_nonexisting_response_file(self):
+        p = Parser(out_file=self.out_file, allow_response_files=True)
+        self.assertRaises(SystemExit, p.evaluate, [u'@foo'])
+        output = self.out_file.getvalue()
+        self.assertContains(output, u'usage: script')
+        self.assertContains(output, u'response file "foo" could not be read')
+
+    def test_unexpected_argument(self):
+        p = Parser(
+            options={'foo': BooleanOption(long='foo')},
+            out_file=self.out_file
+        )
+        self.assertRaises(SystemExit, p.evaluate, [u'--foo=bar'])
+        output = self.out_file.getvalue()
+        self.assertContains(output, u'usage: script [options]')
+        self.assertContains(
+            output,
+            u'option "--foo" does not take an argument'
+        )
+
     def test_nonexisting_short_option(self):
         p = Parser(out_file=self.out_file)
         self.assertRaises(SystemExit, p.evaluate, [u'-f'])
@@ -371,6 +1417,137 @@ class TestParserOutput(OutputTest):
         self.assertContains(output, u'usage: script')
         self.assertContains(output, u'option "-f" does not exist')
 
+    def test_misplaced_nodes(self):
+        remote = Command(commands={'add': Command()})
+        p = Parser(
+            options={'verbose': BooleanOption('v', 'verbose')},
+            commands={
+                'push': Command(options={'force': BooleanOption('f',
+                                                                'force')}),
+                'pull': Command(options={'force': BooleanOption('f',
+                                                                'force')}),
+                'remote': remote,
+                'status': Command(takes_arguments=False)
+            },
+            out_file=self.out_file
+        )
+        self.assertEqual(p.node_index[u'--force'], [(u'pull', ), (u'push', )])
+        self.assertEqual(p.node_index[u'add'], [(u'remote', )])
+        for arguments, message in [
+                ([u'status', u'--force'],
+                 u'"--force" is an option of "script pull", "script push".'),
+                ([u'status', u'-f'],
+                 u'"-f" is an option of "script pull", "script push".'),
+                ([u'push', u'--verbose'],
+                 u'"--verbose" is an option of "script".'),
+                ([u'status', u'add'],
+                 u'"add" is a command of "script remote".')]:
+            self.out_file.seek(0)
+            self.out_file.truncate()
+            self.assertRaises(SystemExit, p.evaluate, arguments)
+            self.assertContains(self.out_file.getvalue(), message)
+
+class TestConstraints(OutputTest):
+    def make_parser(self, constraints):
+        return Parser(
+            options={
+                'json': BooleanOption(long='json'),
+                'xml': BooleanOption(long='xml'),
+                'user': Option('u', 'user'),
+                'password': Option('p', 'password'),
+                'force': BooleanOption('f', 'force'),
+                'dry-run': BooleanOption('n', 'dry-run')
+            },
+            constraints=constraints,
+            out_file=self.out_file
+        )
+
+    def test_satisfied(self):
+        p = self.make_parser([
+            Exclusive('json', 'xml'),
+            Requires('password', 'user'),
+            Conflicts('force', 'dry-run'),
+            Required('user')
+        ])
+        self.assertEqual(
+            p.evaluate([u'--json', u'-u', u'foo', u'-fp', u'bar'])[0],
+            {
+                'json': True, 'xml': False, 'user': u'foo',
+                'password': u'bar', 'force': True, 'dry-run': False
+            }
+        )
+        self.assertEqual(self.out_file.getvalue(), u'')
+
+    def test_violations(self):
+        p = self.make_parser([
+            Exclusive('json', 'xml', required=True),
+            Requires('password', 'user'),
+            Conflicts('force', 'dry-run')
+        ])
+        for arguments, message in [
+                ([u'--json', u'--xml'],
+                 u'The options "--json", "--xml" are mutually exclusive.'),
+                ([], u'One of the options "--json", "--xml" is required.'),
+                ([u'--xml', u'-p', u'bar'],
+                 u'The option "--password" requires "--user".'),
+                ([u'--json', u'-nf'],
+                 u'The option "--force" conflicts with "--dry-run".')]:
+            self.assertRaises(SystemExit, p.evaluate, arguments)
+            output = self.out_file.getvalue()
+            self.assertContains(output, u'usage: script [options]')
+            self.assertContains(output, message)
+            self.out_file.seek(0)
+            self.out_file.truncate()
+
+    def test_required(self):
+        p = self.make_parser([Required('user', 'password')])
+        self.assertRaises(SystemExit, p.evaluate, [u'-u', u'foo'])
+        output = self.out_file.getvalue()
+        self.assertContains(output, u'The option "--password" is required.')
+        self.assert_(u'"--user"' not in output)
+
+    def test_commands(self):
+        p = Parser(
+            options={'force': BooleanOption('f', 'force')},
+            commands={'push': Command(
+                options={
+                    'all': BooleanOption('a', 'all'),
+                    'tags': BooleanOption('t', 'tags')
+                },
+                constraints=[Exclusive('all', 'tags')]
+            )},
+            constraints=[Required('force')],
+            out_file=self.out_file
+        )
+        self.assertEqual(p.evaluate([u'push', u'-a']),
+                         ({'push': ({'all': True, 'tags': False}, [])}, []))
+        self.assertRaises(SystemExit, p.evaluate, [u'push', u'-at'])
+        self.assertContains(self.out_file.getvalue(),
+                            u'usage: script push [options]')
+        self.assertEqual(p.compile().evaluate([u'push', u'-a']),
+                         p.evaluate([u'push', u'-a']))
+
+    def test_plan(self):
+        command = Command(
+            options={
+                'a': BooleanOption('a'),
+                'b': BooleanOption('b'),
+                'c': BooleanOption('c')
+            },
+            constraints=[Exclusive('a', 'b', 'c')]
+        )
+        plan = command.constraint_plan
+        self.assertEqual(plan.bits, {'a': 1, 'b': 2, 'c': 4})
+        self.assert_(command.constraint_plan is plan)
+        self.assertEqual(plan.get_violations(1 | 4),
+                         [u'The options "-a", "-b", "-c" are mutually '
+                          u'exclusive.'])
+        self.assertEqual(plan.get_violations(2), [])
+        command.constraints = [Required('d')]
+        command.clear_constraint_plan()
+        self.assertRaises(ValueError, getattr, command, 'constraint_plan')
+        self.assert_(Command().constraint_plan is None)
+
 class TestHelp(OutputTest):
     def test_commands(self):
         p = Parser(
@@ -431,6 +1608,27 @@ class TestHelp(OutputTest):
             u'something'
         ])
 
+    def test_subcommand(self):
+        p = Parser(
+            commands={
+                'foo': Command(
+                    commands={'bar': Command(short_description=u'bar')},
+                    options={'spam': Option('s')},
+                    long_description=u'foo description'
+                )
+            },
+            out_file=self.out_file
+        )
+        self.assertRaises(SystemExit, p.evaluate, [u'foo', u'help'])
+        output = self.out_file.getvalue()
+        self.assertContainsAll(output, [
+            u'usage: script foo [options] [commands]',
+            u'foo description',
+            u' bar',
+            u' -s'
+        ])
+        self.assertTrue(output.index(u' bar') < output.index(u' help'))
+
     def test_commands_and_options(self):
         p = Parser(
             commands={
@@ -455,6 +1653,403 @@ class TestHelp(OutputTest):
             u' -b'
         ])
 
+class OptionalArgumentOption(Option):
+    requires_argument = False
+    allows_optional_argument = True
+
+    def evaluate(self, callpath, argument=u'implicit'):
+        return argument
+
+class DifferentialTest(OutputTest):
+    vocabulary = [
+        u'-a', u'-b', u'-v', u'-vv', u'-bv', u'-x', u'--apple', u'--app',
+        u'--bool', u'--b', u'--jobs', u'--j', u'--include', u'--unknown',
+        u'-j', u'-I', u'-jI', u'--', u'-', u'build', u'bu', u'b', u'test',
+        u'--jobs=3', u'--bool=x', u'--include=1', u'--apple=',
+        u'stack', u'stash', u'sta', u'help', u'1', u'2', u'foo', u'x,y',
+        u'--opt', u'--opt=y', u'-o', u'-ob', u'-oc', u'-vo'
+    ]
+
+    def make_parser(self):
+        self.calls = []
+        include = AppendOption(IntOption, 'I', 'include')
+        return Parser(
+            options={
+                'apple': Option('a', 'apple'),
+                'bool': BooleanOption('b', 'bool', default=True),
+                'verbose': CountOption('v'),
+                'multiple': MultipleOptions(long='multiple'),
+                'optional': OptionalArgumentOption('o', 'opt')
+            },
+            commands={
+                'build': Command(
+                    options={
+                        'jobs': IntOption('j', 'jobs', default=1),
+                        'include': include
+                    },
+                    commands={
+                        'stack': Command(positionals=[IntPositional('n')]),
+                        'stash': Command(takes_arguments=False)
+                    },
+                    positionals=[Positional('target'), IntPositional('n')],
+                    callback=lambda *args: self.calls.append(args)
+                ),
+                'test': Command(options={'include': include})
+            },
+            positionals=[Positional('x')],
+            defaults={'build': {'jobs': 2}},
+            out_file=self.out_file
+        )
+
+    def run_parser(self, evaluate, arguments):
+        self.calls = []
+        self.out_file.seek(0)
+        self.out_file.truncate()
+        try:
+            result = evaluate(arguments)
+        except (SystemExit, Exception) as error:
+            result = error.__class__
+        return result, self.calls, self.out_file.getvalue()
+
+    def random_arguments(self, n):
+        r = random.Random(42)
+        for _ in range(n):
+            yield [r.choice(self.vocabulary) for _ in range(r.randint(0, 6))]
+
+class TestCompiledParser(DifferentialTest):
+    def test_random_arguments(self):
+        p = self.make_parser()
+        compiled = p.compile()
+        for arguments in self.random_arguments(2000):
+            self.assertEqual(
+                self.run_parser(compiled.evaluate, arguments),
+                self.run_parser(p.evaluate, arguments),
+                arguments
+            )
+
+    def test_source_cache(self):
+        self.assertEqual(self.make_parser().compile().source,
+                         self.make_parser().compile().source)
+
+    def test_overridden_evaluate(self):
+        class CustomCommand(Command):
+            def evaluate(self, callpath, arguments):
+                return u'custom', arguments[:len(arguments)]
+        p = Parser(commands={'custom': CustomCommand()})
+        arguments = [u'custom', u'-a', u'--', u'b']
+        result = {'custom': (u'custom', [u'-a', u'--', u'b'])}, []
+        for evaluate in [p.evaluate, p.compile().evaluate,
+                         p.incremental().evaluate]:
+            self.assertEqual(evaluate(arguments), result)
+        self.assertEqual(p.evaluate_line(u' '.join(arguments)), result)
+
+class TestIncrementalParser(DifferentialTest):
+    def test_random_edits(self):
+        p = self.make_parser()
+        incremental = p.incremental()
+        r = random.Random(23)
+        for arguments in self.random_arguments(300):
+            for _ in range(5):
+                self.assertEqual(
+                    self.run_parser(incremental.evaluate, arguments),
+                    self.run_parser(p.evaluate, arguments),
+                    arguments
+                )
+                arguments = list(arguments)
+                if arguments and r.random() < 0.5:
+                    index = r.randrange(len(arguments))
+                    arguments[index:] = arguments[index + 1:]
+                arguments.append(r.choice(self.vocabulary))
+
+    def test_resume(self):
+        evaluations = []
+        class CountingOption(Option):
+            def evaluate(self, callpath, argument):
+                evaluations.append(argument)
+                return argument
+        include = AppendOption(CountingOption, 'I')
+        p = Parser(commands={'c': Command(options={'include': include})})
+        incremental = p.incremental()
+        self.assertEqual(
+            incremental.evaluate([u'c', u'-I', u'a', u'-I', u'b']),
+            ({'c': ({'include': [u'a', u'b']}, [])}, [])
+        )
+        self.assertEqual(
+            incremental.evaluate([u'c', u'-I', u'a', u'-I', u'x', u'y']),
+            ({'c': ({'include': [u'a', u'x']}, [u'y'])}, [])
+        )
+        self.assertEqual(incremental.resumed_at, 3)
+        self.assertEqual(evaluations, [u'a', u'b', u'x'])
+        self.assertEqual(
+            incremental.evaluate([u'c', u'-I', u'a']),
+            ({'c': ({'include': [u'a']}, [])}, [])
+        )
+        self.assertEqual(incremental.resumed_at, 3)
+
+    def test_optional_argument_appended(self):
+        p = Parser(options={'o': OptionalArgumentOption('o', 'opt')})
+        incremental = p.incremental()
+        self.assertEqual(incremental.evaluate([u'--opt']),
+                         ({'o': u'implicit'}, []))
+        self.assertEqual(incremental.evaluate([u'--opt', u'value']),
+                         p.evaluate([u'--opt', u'value']))
+
+    def test_response_files(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'arguments')
+            with open(path, 'wb') as f:
+                f.write(b'-I\na\n')
+            p = Parser(options={'include': AppendOption(short='I')},
+                       allow_response_files=True)
+            incremental = p.incremental()
+            for arguments in [[u'@' + path], [u'@' + path, u'-I', u'b']]:
+                self.assertEqual(incremental.evaluate(arguments),
+                                 p.evaluate(arguments))
+        finally:
+            shutil.rmtree(directory)
+
+class TestThreadSafety(DifferentialTest):
+    def test_concurrent_evaluation(self):
+        p = self.make_parser()
+        p.build.jobs.converter_cache = ConverterCache(maxsize=4)
+        p.line_cache_size = 8
+        compiled = p.compile()
+        cases = []
+        for arguments in self.random_arguments(500):
+            try:
+                result = p.evaluate(arguments)
+            except (SystemExit, Exception):
+                continue
+            line = u' '.join(pipes.quote(a.encode('utf-8')).decode('utf-8')
+                             for a in arguments)
+            cases.append((arguments, line, result))
+        failures = []
+        def run(seed):
+            r = random.Random(seed)
+            try:
+                for _ in range(3):
+                    for arguments, line, result in r.sample(cases,
+                                                            len(cases)):
+                        for evaluate, argument in [(p.evaluate, arguments),
+                                                   (compiled.evaluate,
+                                                    arguments),
+                                                   (p.evaluate_line, line)]:
+                            if evaluate(argument) != result:
+                                failures.append(argument)
+            except Exception as error:
+                failures.append(error)
+        threads = [threading.Thread(target=run, args=(i, ))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue(cases)
+        self.assertEqual(failures, [])
+
+    def test_concurrent_telemetry(self):
+        batches = []
+        p = Parser(options={'verbose': CountOption('v')})
+        telemetry = Telemetry(batches.append, sample_every=3,
+                              flush_interval=3600)
+        telemetry.install(p)
+        def run():
+            for _ in range(3000):
+                p.evaluate([u'-v'])
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        telemetry.flush()
+        self.assertEqual(sum(batch[opts.OPTION][u'verbose']
+                             for batch in batches), 8000)
+
+class TestEvaluateLine(DifferentialTest):
+    def test_random_lines(self):
+        p = self.make_parser()
+        lines = [u' '.join(pipes.quote(a.encode('utf-8')).decode('utf-8')
+                           for a in arguments)
+                 for arguments in self.random_arguments(500)]
+        for _ in range(2):
+            for line in lines:
+                self.assertEqual(
+                    self.run_parser(p.evaluate_line, line),
+                    self.run_parser(p.evaluate, shlex.split(line)),
+                    line
+                )
+
+    def test_quoting(self):
+        p = Parser(options={'message': Option('m')})
+        self.assertEqual(
+            p.evaluate_line(u' -m "hello world" \'b\xe4r baz\' '),
+            ({'message': u'hello world'}, [u'b\xe4r baz'])
+        )
+
+    def test_cache(self):
+        evaluations = []
+        class CountingOption(Option):
+            def evaluate(self, callpath, argument):
+                evaluations.append(argument)
+                return argument
+        p = Parser(options={'foo': CountingOption('f')})
+        p.line_cache_size = 2
+        for line in [u'-f a', u'-f a ', u'-f b', u'-f c', u'-f a']:
+            p.evaluate_line(line)
+        self.assertEqual(evaluations, [u'a', u'a', u'b', u'c', u'a'])
+        self.assertEqual(p._line_cache.keys(), [u'-f c', u'-f a'])
+        plan = p._line_cache[u'-f a'][1]
+        self.assertEqual(p.evaluate_line(u'-f a'), ({'foo': u'a'}, []))
+        self.assertTrue(p._line_cache[u'-f a'][1] is plan)
+        p.clear_line_cache()
+        self.assertEqual(len(p._line_cache), 0)
+
+class TestEvaluateRecords(TestCase):
+    def make_parser(self):
+        return Parser(
+            options={'verbose': CountOption('v')},
+            commands={'build': Command(
+                options={'jobs': IntOption('j', 'jobs', default=1)},
+                positionals=[Positional('target')],
+                callback=lambda options, arguments: None
+            )},
+            takes_arguments=False
+        )
+
+    def test_pickle(self):
+        p = pickle.loads(pickle.dumps(self.make_parser().snapshot()))
+        self.assertEqual(
+            p.evaluate([u'-vv', u'build', u'--jobs=2', u'all']),
+            ({'build': ({'jobs': 2}, [u'all'])}, [])
+        )
+        self.assertTrue(p.build.callback is None)
+
+    def test_snapshot_missing(self):
+        p = pickle.loads(pickle.dumps(self.make_parser().snapshot()))
+        self.assertTrue(p.verbose.default is opts.missing)
+
+    def test_stop_early(self):
+        p = self.make_parser()
+        produced = []
+        def records():
+            while True:
+                produced.append(None)
+                yield [u'build', u'-j', u'2']
+        results = []
+        def run():
+            for result in p.evaluate_records(records(), processes=2,
+                                             chunksize=4):
+                results.append(result)
+                if len(results) == 10:
+                    # wait for the records to be taken up to the limit of
+                    # pending records
+                    while len(produced) <= 2 * 4 * 4 + 10:
+                        time.sleep(0.01)
+                    time.sleep(0.1)
+                    break
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(results), 10)
+
+    def test_evaluate_records(self):
+        p = self.make_parser()
+        records = [
+            [u'-v', u'build'],
+            u'build -j 4 "all targets"',
+            u'build -j four',
+            u'unknown'
+        ] * 50
+        for ordered in [True, False]:
+            results = list(p.evaluate_records(iter(records), processes=2,
+                                              ordered=ordered, chunksize=3))
+            self.assertEqual(len(results), len(records))
+            if ordered:
+                self.assertEqual(results[:4], [
+                    ([u'-v', u'build'],
+                     ({'build': ({'jobs': 1}, [])}, []), None),
+                    ([u'build', u'-j', u'4', u'all targets'],
+                     ({'build': ({'jobs': 4}, [u'all targets'])}, []), None),
+                    ([u'build', u'-j', u'four'], None,
+                     u"ValueError: invalid literal for int() with base 10: "
+                     u"'four'"),
+                    ([u'unknown'], None,
+                     u'usage: {0} [options] [commands]\n\nThe given command '
+                     u'"unknown" does not exist.\n'.format(p.script_name))
+                ])
+            self.assertEqual(
+                sorted(results),
+                sorted(p.evaluate_records(records, processes=1))
+            )
+
+class TestColumnarResults(TestCase):
+    def test_column(self):
+        c = Column(1)
+        c.append(1)
+        c.append(opts.missing)
+        c.append(2)
+        self.assertEqual(c.typecode, 'l')
+        self.assertEqual(c.to_list(), [None, 1, None, 2])
+        self.assertEqual(list(c.mask), [1, 0, 1, 0])
+        c.append(u'foo')
+        self.assertEqual(c.typecode, 'O')
+        self.assertEqual(c.to_list(), [None, 1, None, 2, u'foo'])
+
+    def test_string_column(self):
+        c = Column()
+        for value in [u'foo', u'bar', u'foo', opts.missing, u'foo']:
+            c.append(value)
+        self.assertEqual(c.typecode, 's')
+        self.assertEqual(c.dictionary, [u'foo', u'bar'])
+        self.assertEqual(list(c.values), [0, 1, 0, 0, 0])
+        self.assertEqual(c.to_list(), [u'foo', u'bar', u'foo', None, u'foo'])
+
+    def test_boolean_column(self):
+        c = Column()
+        c.append(True)
+        c.append(False)
+        self.assertEqual(c.typecode, 'b')
+        self.assertEqual(c.to_list(), [True, False])
+        c.append(1)
+        self.assertEqual(c.typecode, 'O')
+        self.assertEqual(c.to_list(), [True, False, 1])
+
+    def test_overflow(self):
+        c = Column()
+        c.append(1)
+        c.append(2 ** 100)
+        self.assertEqual(c.to_list(), [1, 2 ** 100])
+
+    def test_evaluate_columnar(self):
+        p = Parser(
+            options={'verbose': CountOption('v')},
+            commands={'build': Command(
+                options={'jobs': IntOption('j', 'jobs')},
+                positionals=[Positional('target')]
+            )},
+            takes_arguments=False
+        )
+        results = p.evaluate_columnar([
+            [u'-vv'],
+            u'build -j 4 all',
+            u'build -j four',
+            u'build foo bar'
+        ], processes=1)
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results.commands.to_list(),
+                         [u'', u'build', None, u'build'])
+        self.assertEqual(results['verbose'].to_list(), [2, None, None, None])
+        self.assertEqual(results['build.jobs'].to_list(),
+                         [None, 4, None, None])
+        self.assertEqual(results.get_remaining(0), [])
+        self.assertEqual(results.get_remaining(1), [u'all'])
+        self.assertEqual(results.get_remaining(3), [u'foo', u'bar'])
+        self.assertEqual(results.errors[0], None)
+        self.assertTrue(results.errors[2].startswith(u'ValueError'))
+
 class TestUsage(OutputTest):
     def test_only_commands(self):
         p = Parser(
@@ -514,12 +2109,34 @@ def suite():
     suite.addTest(unittest.makeSuite(TestBooleanOption))
     suite.addTest(unittest.makeSuite(TestNumberOptions))
     suite.addTest(unittest.makeSuite(TestMultipleOptions))
+    suite.addTest(unittest.makeSuite(TestAccumulatingOptions))
+    suite.addTest(unittest.makeSuite(TestRangeSet))
+    suite.addTest(unittest.makeSuite(TestConverterCache))
+    suite.addTest(unittest.makeSuite(TestChoices))
+    suite.addTest(unittest.makeSuite(TestDynamicChoiceOption))
+    suite.addTest(unittest.makeSuite(TestFileOption))
     suite.addTest(unittest.makeSuite(TestPositional))
     suite.addTest(unittest.makeSuite(TestNumberPositionals))
+    suite.addTest(unittest.makeSuite(TestPathPositional))
+    suite.addTest(unittest.makeSuite(TestGlobPositional))
+    suite.addTest(unittest.makeSuite(TestStreamPositional))
+    suite.addTest(unittest.makeSuite(TestTokenStream))
+    suite.addTest(unittest.makeSuite(TestCallPath))
     suite.addTest(unittest.makeSuite(TestCommand))
+    suite.addTest(unittest.makeSuite(TestPluginRegistry))
     suite.addTest(unittest.makeSuite(TestParser))
+    suite.addTest(unittest.makeSuite(TestConfigSource))
+    suite.addTest(unittest.makeSuite(TestResponseFiles))
+    suite.addTest(unittest.makeSuite(TestTelemetry))
     suite.addTest(unittest.makeSuite(TestParserOutput))
+    suite.addTest(unittest.makeSuite(TestConstraints))
     suite.addTest(unittest.makeSuite(TestHelp))
+    suite.addTest(unittest.makeSuite(TestCompiledParser))
+    suite.addTest(unittest.makeSuite(TestIncrementalParser))
+    suite.addTest(unittest.makeSuite(TestThreadSafety))
+    suite.addTest(unittest.makeSuite(TestEvaluateLine))
+    suite.addTest(unittest.makeSuite(TestEvaluateRecords))
+    suite.addTest(unittest.makeSuite(TestColumnarResults))
     suite.addTest(unittest.makeSuite(TestUsage))
     return suite
 